@@ -5,41 +5,26 @@ Apple Notes 搜索 API 服务器
 """
 
 import sys
+import threading
 import os
 from pathlib import Path
-from typing import List
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 
 import chromadb
-from chromadb.api.types import EmbeddingFunction, Documents
 
-# 导入 BGE-M3 模型
-from FlagEmbedding import FlagModel
+# 共享 BGE-M3 嵌入服务（每台机器只加载一份模型）
+from embedding_service import get_embedding_function, normalize_query
+from index_state import AliasWatcher
+from indexer import count_indexed_notes
+from lexical_index import get_lexical_index
+from search_cache import ResultCache
+from searcher import search
 
 # ============ 配置 ============
 NOTES_DB = Path.home() / "notes.db"
 CHROMA_DB = Path.home() / "Documents/apple-notes-mcp/chroma_db"
 
-# ============ BGE-M3 嵌入函数 ============
-class BGEEmbeddingFunction(EmbeddingFunction):
-    """
-    BGE-M3 嵌入函数
-    使用 BAAI/bge-m3 模型生成 1024 维向量
-    """
-    def __init__(self):
-        print("🚀 加载 BGE-M3 模型...", file=sys.stderr)
-        self.model = FlagModel(
-            'BAAI/bge-m3',
-            query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
-            use_fp16=True
-        )
-        print("✅ BGE-M3 模型加载完成", file=sys.stderr)
-
-    def __call__(self, input: Documents) -> List[List[float]]:
-        embeddings = self.model.encode(input)
-        return embeddings.tolist()
-
 # ============ 初始化 Flask 和 ChromaDB ============
 app = Flask(__name__)
 CORS(app)  # 允许跨域请求
@@ -48,24 +33,63 @@ CORS(app)  # 允许跨域请求
 _chroma_client = None
 _collection = None
 _bge_ef = None
+_init_lock = threading.Lock()  # 工作线程可能并发触发懒加载
+_alias_watcher = AliasWatcher(CHROMA_DB)  # 当前提供服务的 collection 名
 
 def get_collection():
-    """获取 ChromaDB collection（懒加载）"""
+    """获取别名指向的 ChromaDB collection（懒加载，重建切换别名后自动换到新版本，无需重启）"""
     global _chroma_client, _collection, _bge_ef
-    if _collection is None:
-        print("📂 初始化 ChromaDB...", file=sys.stderr)
-        _chroma_client = chromadb.PersistentClient(path=str(CHROMA_DB))
-
-        if _bge_ef is None:
-            _bge_ef = BGEEmbeddingFunction()
-
-        _collection = _chroma_client.get_or_create_collection(
-            "apple_notes",
-            embedding_function=_bge_ef
-        )
-        print("✅ ChromaDB 初始化完成", file=sys.stderr)
+    name = _alias_watcher.current()
+    with _init_lock:
+        if _collection is None or _collection.name != name:
+            print("📂 初始化 ChromaDB...", file=sys.stderr)
+            if _chroma_client is None:
+                _chroma_client = chromadb.PersistentClient(path=str(CHROMA_DB))
+
+            if _bge_ef is None:
+                _bge_ef = get_embedding_function()
+
+            _collection = _chroma_client.get_or_create_collection(
+                name,
+                embedding_function=_bge_ef
+            )
+            print("✅ ChromaDB 初始化完成", file=sys.stderr)
     return _collection
 
+# 搜索结果缓存（索引更新后自动失效）
+_result_cache = ResultCache(CHROMA_DB)
+
+def _run_search(query, limit):
+    """执行向量搜索，返回匹配的笔记列表（可缓存，不含请求相关的字段）"""
+    collection = get_collection()
+    return search(collection, query, limit, lexical=get_lexical_index(CHROMA_DB, collection.name))
+
+def _format_results(query, notes):
+    """检索结果格式化为 JSON 结构（按本次请求的原始查询）"""
+    if not notes:
+        return {
+            "results": [],
+            "total": 0,
+            "message": "没有找到相关备忘录"
+        }
+
+    # 格式化结果（content 为笔记中最匹配的段落）
+    formatted_results = [
+        {
+            "title": note['title'],
+            "content": note['passage'],
+            "updated": note['updated'],
+            "score": 1.0 - note['distance']  # 转换距离为相似度分数
+        }
+        for note in notes
+    ]
+
+    return {
+        "results": formatted_results,
+        "total": len(formatted_results),
+        "query": query
+    }
+
 # ============ API 端点 ============
 
 @app.route('/health', methods=['GET'])
@@ -77,8 +101,8 @@ def health():
         "version": "1.0.0"
     })
 
-@app.route('/search', methods=['POST'])
-def search():
+@app.route('/search', methods=['POST'], endpoint='search')
+def search_endpoint():
     """
     搜索备忘录
 
@@ -109,38 +133,10 @@ def search():
         if not query:
             return jsonify({"error": "查询不能为空"}), 400
 
-        collection = get_collection()
-        results = collection.query(
-            query_texts=[query],
-            n_results=limit
-        )
-
-        if not results['documents'][0]:
-            return jsonify({
-                "results": [],
-                "total": 0,
-                "message": "没有找到相关备忘录"
-            })
-
-        # 格式化结果
-        formatted_results = []
-        for i, (doc, metadata, distance) in enumerate(zip(
-            results['documents'][0],
-            results['metadatas'][0],
-            results['distances'][0] if 'distances' in results else [0] * len(results['documents'][0])
-        )):
-            formatted_results.append({
-                "title": metadata.get('title', '(无标题)'),
-                "content": doc,
-                "updated": metadata.get('updated', ''),
-                "score": 1.0 - distance  # 转换距离为相似度分数
-            })
-
-        return jsonify({
-            "results": formatted_results,
-            "total": len(formatted_results),
-            "query": query
-        })
+        # 相同查询在索引未变化时直接复用检索结果；响应里的 query 仍是本次请求的原文
+        key = ("search", normalize_query(query), limit)
+        notes = _result_cache.get_or_compute(key, lambda: _run_search(query, limit))
+        return jsonify(_format_results(query, notes))
 
     except Exception as e:
         print(f"❌ 搜索失败: {str(e)}", file=sys.stderr)
@@ -151,12 +147,14 @@ def stats():
     """获取统计信息"""
     try:
         collection = get_collection()
-        count = collection.count()
+        count = count_indexed_notes(collection)
 
         return jsonify({
             "indexed_notes": count,
             "model": "BGE-M3",
             "dimensions": 1024,
+            "query_cache": get_embedding_function().query_cache.stats(),
+            "result_cache": _result_cache.stats(),
             "status": "ready"
         })
     except Exception as e:
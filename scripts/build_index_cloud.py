@@ -12,11 +12,10 @@
 import sys
 import sqlite3
 from pathlib import Path
-from typing import List
 
 import chromadb
-from chromadb.api.types import EmbeddingFunction, Documents
-from FlagEmbedding import FlagModel
+from index_state import read_alias
+from indexer import count_indexed_notes, rebuild_index
 
 # ============ 配置 ============
 # 云端路径配置
@@ -32,22 +31,6 @@ print(f"📂 笔记数据库: {NOTES_DB}")
 print(f"🗂️  向量数据库: {CHROMA_DB}")
 print()
 
-# ============ BGE-M3 嵌入函数 ============
-class BGEEmbeddingFunction(EmbeddingFunction):
-    """BGE-M3 嵌入函数"""
-    def __init__(self):
-        print("🚀 加载 BGE-M3 模型...")
-        self.model = FlagModel(
-            'BAAI/bge-m3',
-            query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
-            use_fp16=True
-        )
-        print("✅ BGE-M3 模型加载完成")
-
-    def __call__(self, input: Documents) -> List[List[float]]:
-        embeddings = self.model.encode(input)
-        return embeddings.tolist()
-
 # ============ 构建索引 ============
 def build_index():
     """从 notes.db 构建向量索引"""
@@ -63,13 +46,12 @@ def build_index():
     # 读取笔记
     print("\n📖 读取笔记数据...")
     conn = sqlite3.connect(str(NOTES_DB))
-    cursor = conn.execute("SELECT id, title, body, updated FROM notes")
-    notes = cursor.fetchall()
-    conn.close()
+    total = conn.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
 
-    print(f"✅ 读取到 {len(notes)} 条笔记")
+    print(f"✅ 读取到 {total} 条笔记")
 
-    if len(notes) == 0:
+    if total == 0:
+        conn.close()
         print("❌ 错误: notes.db 中没有数据")
         sys.exit(1)
 
@@ -78,56 +60,31 @@ def build_index():
     CHROMA_DB.parent.mkdir(parents=True, exist_ok=True)
 
     client = chromadb.PersistentClient(path=str(CHROMA_DB))
-    bge_ef = BGEEmbeddingFunction()
-
-    # 创建或获取 collection
-    collection = client.get_or_create_collection(
-        name="apple_notes",
-        embedding_function=bge_ef,
-        metadata={"description": "Apple Notes 语义搜索 (BGE-M3, 1024维)"}
-    )
-
-    # 清空现有数据（如果有）
-    existing_count = collection.count()
-    if existing_count > 0:
-        print(f"⚠️  检测到现有索引 ({existing_count} 条)，将清空后重建")
-        collection.delete(where={})  # 清空
-
-    # 批量索引
-    print(f"\n🔨 开始构建索引（{len(notes)} 条笔记）...")
-    batch_size = 50
-
-    for i in range(0, len(notes), batch_size):
-        batch = notes[i:i+batch_size]
-
-        ids = [str(note[0]) for note in batch]
-        documents = [note[2] or "" for note in batch]  # body
-        metadatas = [
-            {
-                "title": note[1] or "(无标题)",
-                "updated": note[3] or ""
-            }
-            for note in batch
-        ]
-
-        collection.add(
-            ids=ids,
-            documents=documents,
-            metadatas=metadatas
-        )
-
-        progress = min(i + batch_size, len(notes))
-        print(f"  进度: {progress}/{len(notes)} ({progress*100//len(notes)}%)")
+    print(f"ℹ️  当前提供服务的 collection: {read_alias(CHROMA_DB)}")
+
+    # 构建到影子 collection，完成后切换别名；中断后重新运行从断点继续，
+    # 内容未变的笔记从当前 collection 复制，不重新嵌入
+    print(f"\n🔨 开始构建索引（{total} 条笔记）...")
+    failed = set()
+    collection, _ = rebuild_index(client, conn, chroma_path=CHROMA_DB, batch_size=50, failed=failed)
+    conn.close()
+
+    if failed:
+        # 没有切换到新版本，线上仍是原来的 collection；重新运行从断点继续
+        print(f"\n❌ 错误: {len(failed)} 条笔记索引失败，未切换到新索引", file=sys.stderr)
+        for note_id in sorted(failed)[:20]:
+            print(f"  - {note_id}", file=sys.stderr)
+        sys.exit(1)
 
     # 验证
-    final_count = collection.count()
+    final_count = count_indexed_notes(collection)
     print(f"\n✅ 索引构建完成！")
     print(f"📊 统计:")
-    print(f"  - 笔记总数: {len(notes)}")
+    print(f"  - 笔记总数: {total}")
     print(f"  - 已索引: {final_count}")
-    print(f"  - 覆盖率: {final_count*100//len(notes)}%")
+    print(f"  - 覆盖率: {final_count*100//total}%")
 
-    if final_count != len(notes):
+    if final_count != total:
         print(f"\n⚠️  警告: 索引数量与笔记数量不一致")
 
     return final_count
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+日期过滤
+导出的时间是 AppleScript «class isot» 字符串（如 2024-03-01T10:00:00，本地时间）。
+字符串在 Chroma 里不能可靠地做范围比较，索引时额外存一份整数时间戳
+（created_ts / updated_ts，Unix 秒），过滤条件一律用数值范围。
+"""
+
+from datetime import datetime, timedelta
+
+# ============ 时间戳 ============
+def to_timestamp(value):
+    """
+    ISO 日期/时间字符串转 Unix 时间戳（秒，按本机时区解释）
+    无法解析时返回 None
+    """
+    if not value:
+        return None
+    try:
+        return int(datetime.fromisoformat(str(value).strip()).timestamp())
+    except ValueError:
+        return None
+
+def timestamp_fields(created, updated):
+    """索引元数据里的数值时间字段，无法解析的字段不写（Chroma 元数据不接受 None）"""
+    fields = {}
+    for key, value in (("created_ts", created), ("updated_ts", updated)):
+        timestamp = to_timestamp(value)
+        if timestamp is not None:
+            fields[key] = timestamp
+    return fields
+
+# ============ 过滤条件 ============
+def _parse_date(value, name):
+    try:
+        return datetime.fromisoformat(value.strip())
+    except ValueError:
+        raise ValueError(f"{name} 日期格式错误: {value}（应为 YYYY-MM-DD）")
+
+def date_range(date_after="", date_before=""):
+    """
+    把 YYYY-MM-DD 日期转成闭区间 [起始秒, 结束秒]
+    date_before 包含当天整天（只给日期时取到当天 23:59:59）
+    Returns:
+        (start, end)，未指定的一端为 None
+    """
+    start = end = None
+    if date_after:
+        start = int(_parse_date(date_after, "date_after").timestamp())
+    if date_before:
+        parsed = _parse_date(date_before, "date_before")
+        if len(date_before.strip()) <= 10:
+            parsed += timedelta(days=1)
+            end = int(parsed.timestamp()) - 1
+        else:
+            end = int(parsed.timestamp())
+    return start, end
+
+def range_where(start=None, end=None):
+    """
+    [start, end] 闭区间转成 Chroma where 条件（数值范围谓词）
+    Returns:
+        where 字典，两端都未指定时为 None
+    """
+    conditions = []
+    if start is not None:
+        conditions.append({"updated_ts": {"$gte": start}})
+    if end is not None:
+        conditions.append({"updated_ts": {"$lte": end}})
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    # Chroma 要求同一字段的多个条件用 $and 组合
+    return {"$and": conditions}
+
+def date_where(date_after="", date_before=""):
+    """按更新时间过滤的 Chroma where 条件，无过滤时为 None"""
+    return range_where(*date_range(date_after, date_before))
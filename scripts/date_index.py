@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+内存日期索引
+按 updated_ts 排序的 (时间戳, 块 id) 列表，二分查找即可得到某个时间窗口内的全部块。
+refine_search 据此估算过滤条件的选择性：窗口很窄时只对窗口内的向量做精确计算，
+不必让 HNSW 在整个 collection 上检索后再过滤。
+只读取 id 和元数据（不读向量），索引代数变化时重新加载。
+"""
+
+import threading
+from bisect import bisect_left, bisect_right
+
+from index_state import GenerationWatcher
+
+# ============ 配置 ============
+PAGE_SIZE = 1000  # 加载时分页读取元数据的页大小
+
+# ============ 日期索引 ============
+class DateIndex:
+    """某个 collection 的 (updated_ts, 块 id) 有序索引"""
+    def __init__(self, collection, chroma_path):
+        self.collection = collection
+        self._watcher = GenerationWatcher(chroma_path)
+        self._generation = None
+        self._timestamps = []
+        self._ids = []
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        entries = []
+        total = 0
+        offset = 0
+        while True:
+            page = self.collection.get(include=["metadatas"], limit=PAGE_SIZE, offset=offset)
+            if not page["ids"]:
+                break
+            for doc_id, metadata in zip(page["ids"], page["metadatas"]):
+                timestamp = metadata.get("updated_ts")
+                if timestamp is not None:
+                    entries.append((timestamp, doc_id))
+            total += len(page["ids"])
+            offset += len(page["ids"])
+        entries.sort()
+        self._timestamps = [timestamp for timestamp, _ in entries]
+        self._ids = [doc_id for _, doc_id in entries]
+        self._total = total
+
+    def _refresh(self):
+        """索引代数变化（或首次使用）时重新加载"""
+        generation = self._watcher.current()
+        if generation != self._generation:
+            self._load()
+            self._generation = generation
+
+    def select(self, start=None, end=None):
+        """
+        取更新时间落在 [start, end] 闭区间内的块
+        Returns:
+            (块 id 列表, collection 总块数)
+        """
+        with self._lock:
+            self._refresh()
+            lo = 0 if start is None else bisect_left(self._timestamps, start)
+            hi = len(self._timestamps) if end is None else bisect_right(self._timestamps, end)
+            return self._ids[lo:hi], self._total
+
+# ============ 按 collection 获取 ============
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_date_index(chroma_path, collection):
+    """获取（并缓存）某个 collection 的日期索引"""
+    key = (str(chroma_path), collection.name)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None or index.collection is not collection:
+            # 别名切换到新版本后，同一向量库下其它版本的索引不再使用
+            for other in [k for k in _indexes if k[0] == key[0] and k != key]:
+                del _indexes[other]
+            index = _indexes[key] = DateIndex(collection, chroma_path)
+        return index
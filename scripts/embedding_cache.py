@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+持久化嵌入缓存
+按 (模型标识, 嵌入文本哈希) 缓存每个块的稠密向量和稀疏词权重，跨重建、跨 collection 版本复用。
+云端每次部署重建索引、或全量重建到新版本 collection 时，文本没变的块直接读缓存，不经过模型。
+
+存储（默认放在向量数据库目录旁边的 embedding_cache/ 下）:
+    vectors.f16  稠密向量，float16 按行追加，读取时 np.memmap，不整体载入内存
+    index.db     SQLite 键索引: (模型标识, 文本哈希) → 行号 + 稀疏词权重
+
+缓存只追加，重建索引后由 compact() 回收当前 collection 不再用到的条目（indexer.py cache-gc）。
+
+环境变量配置:
+    EMBED_CACHE: 1 / 0，是否启用（默认 1）
+    EMBED_CACHE_DIR: 缓存目录（默认 <向量数据库目录的上一级>/embedding_cache，云端可指向持久卷）
+"""
+
+import fcntl
+import hashlib
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from embedding_service import EMBEDDING_DIM, MAX_LENGTH, MODEL_NAME, get_embedding_function
+
+# ============ 配置 ============
+CACHE_ENABLED = os.environ.get("EMBED_CACHE", "1").lower() in ("1", "true", "yes")
+CACHE_DIR = os.environ.get("EMBED_CACHE_DIR")
+MODEL_ID = f"{MODEL_NAME}@{MAX_LENGTH}"  # 截断长度不同，向量也不同
+LOOKUP_CHUNK = 500  # 每次 IN 查询的键数
+COMPACT_CHUNK = 4096  # 压缩时每次搬动的向量行数
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    model TEXT,
+    hash BLOB,
+    row INTEGER,
+    sparse BLOB,
+    PRIMARY KEY (model, hash)
+) WITHOUT ROWID;
+"""
+
+def text_key(text):
+    """嵌入文本的哈希（32 字节摘要）"""
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+def _pack_sparse(weights):
+    """稀疏词权重 → int32 词 id 数组 + float32 权重数组的字节串"""
+    ids = np.fromiter((int(token) for token in weights), dtype=np.int32, count=len(weights))
+    values = np.fromiter((float(weight) for weight in weights.values()), dtype=np.float32, count=len(weights))
+    return ids.tobytes() + values.tobytes()
+
+def _unpack_sparse(blob):
+    count = len(blob) // 8
+    ids = np.frombuffer(blob, dtype=np.int32, count=count)
+    values = np.frombuffer(blob, dtype=np.float32, count=count, offset=4 * count)
+    return dict(zip(ids.tolist(), values.tolist()))
+
+# ============ 缓存 ============
+class EmbeddingCache:
+    """
+    float16 向量文件 + SQLite 键索引
+    只追加不改写：同一文本再次写入时索引指向新行，旧行留在文件里（不影响正确性），由 compact() 回收
+    跨进程用 vectors.lock 加锁：写入、压缩加排他锁，读取加共享锁
+    """
+    def __init__(self, directory, model_id=MODEL_ID, dim=EMBEDDING_DIM):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.model_id = model_id
+        self.dim = dim
+        self.row_bytes = dim * 2
+        self.vectors_path = self.directory / "vectors.f16"
+        self.vectors_path.touch(exist_ok=True)
+        self.lock_path = self.directory / "vectors.lock"
+        self.compacting_path = self.directory / "compacting"
+        self._map = None
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.directory / "index.db"), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        if self.compacting_path.exists():
+            self._reset()
+
+    def _reset(self):
+        """上次压缩中途中断，行号和文件可能对不上，整个缓存作废（宁可重新编码，也不读错行）"""
+        with open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not self.compacting_path.exists():
+                return  # 其他进程已经清理过
+            with self._conn:
+                self._conn.execute("DELETE FROM entries")
+            os.truncate(self.vectors_path, 0)
+            self.compacting_path.unlink()
+
+    def _matrix(self, rows_needed):
+        """按需（重新）映射向量文件，文件变长后才重新 mmap"""
+        if self._map is None or self._map.shape[0] < rows_needed:
+            rows = self.vectors_path.stat().st_size // self.row_bytes
+            self._map = np.memmap(self.vectors_path, dtype=np.float16, mode="r", shape=(rows, self.dim))
+        return self._map
+
+    def get(self, keys):
+        """
+        批量查询
+        Returns:
+            {键: (稠密向量, 稀疏词权重)}，只包含命中的键
+        """
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock, open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)  # 压缩期间行号会变，等压缩完成再读
+            for i in range(0, len(keys), LOOKUP_CHUNK):
+                chunk = keys[i:i + LOOKUP_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT hash, row, sparse FROM entries WHERE model = ? AND hash IN ({placeholders})",
+                    [self.model_id, *chunk]
+                ).fetchall()
+                if not rows:
+                    continue
+                matrix = self._matrix(max(row for _, row, _ in rows) + 1)
+                vectors = matrix[[row for _, row, _ in rows]].astype(np.float32)
+                for (key, _, sparse), vector in zip(rows, vectors):
+                    found[bytes(key)] = (vector.tolist(), _unpack_sparse(sparse))
+        return found
+
+    def put(self, keys, dense, sparse):
+        """追加一批向量并登记键（跨进程加文件锁，多个索引进程不会写错行号）"""
+        keys = list(keys)
+        if not keys:
+            return
+        matrix = np.asarray(dense, dtype=np.float16)
+        if matrix.shape != (len(keys), self.dim):
+            raise ValueError(f"嵌入维度不匹配: {matrix.shape}，应为 ({len(keys)}, {self.dim})")
+        with self._lock, open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            size = self.vectors_path.stat().st_size
+            with open(self.vectors_path, "r+b") as f:
+                start = size // self.row_bytes
+                f.truncate(start * self.row_bytes)  # 上次写到一半中断留下的残行
+                f.seek(start * self.row_bytes)
+                f.write(matrix.tobytes())
+            # 向量落盘后再登记，中断时最多留下没有索引的行
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO entries (model, hash, row, sparse) VALUES (?, ?, ?, ?)",
+                    [
+                        (self.model_id, key, start + i, _pack_sparse(weights))
+                        for i, (key, weights) in enumerate(zip(keys, sparse))
+                    ]
+                )
+
+    def compact(self, keep):
+        """
+        只保留 keep 中的键（当前模型标识），其余条目连同其他模型标识的条目一起删除
+        保留的向量行按原顺序原地前移，再截断文件
+        Args:
+            keep: 仍在使用的文本哈希集合（见 text_key）
+        Returns:
+            删除的条目数
+        """
+        with self._lock, open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            total = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            kept = [
+                (bytes(key), row, sparse) for key, row, sparse in self._conn.execute(
+                    "SELECT hash, row, sparse FROM entries WHERE model = ? ORDER BY row", (self.model_id,)
+                )
+                if bytes(key) in keep
+            ]
+
+            self.compacting_path.touch()  # 中途中断时，下次打开缓存会整个作废
+            self._map = None
+            rows = np.fromiter((row for _, row, _ in kept), dtype=np.int64, count=len(kept))
+            if len(rows) and rows[-1] >= len(rows):
+                matrix = np.memmap(self.vectors_path, dtype=np.float16, mode="r+",
+                                   shape=(int(rows[-1]) + 1, self.dim))
+                # 行号递增且新行号不大于旧行号，按块前移不会覆盖后面还没搬的行
+                for start in range(0, len(rows), COMPACT_CHUNK):
+                    stop = start + COMPACT_CHUNK
+                    matrix[start:start + len(rows[start:stop])] = matrix[rows[start:stop]]
+                matrix.flush()
+                del matrix
+            os.truncate(self.vectors_path, len(kept) * self.row_bytes)
+            with self._conn:
+                self._conn.execute("DELETE FROM entries")
+                self._conn.executemany(
+                    "INSERT INTO entries (model, hash, row, sparse) VALUES (?, ?, ?, ?)",
+                    [(self.model_id, key, i, sparse) for i, (key, _, sparse) in enumerate(kept)]
+                )
+            self.compacting_path.unlink()
+        return total - len(kept)
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM entries WHERE model = ?", (self.model_id,)
+            ).fetchone()[0]
+
+class CachedEmbedder:
+    """
+    先查缓存，只把没命中的文本交给模型（默认为共享嵌入函数，第一次未命中时才加载）
+    接口与 BGEEmbeddingFunction.embed_documents 相同，可作为 index_notes(embedder=...) 传入
+    """
+    def __init__(self, cache, embedder=None):
+        self.cache = cache
+        self.embedder = embedder
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        keys = [text_key(text) for text in texts]
+        found = self.cache.get(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)  # 同一批里的重复文本只编码一次
+        if missing:
+            embedder = self.embedder or get_embedding_function()
+            dense, sparse = embedder.embed_documents(list(missing.values()))
+            self.cache.put(missing.keys(), dense, sparse)
+            found.update(zip(missing.keys(), zip(dense, sparse)))
+
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+        return [found[key][0] for key in keys], [found[key][1] for key in keys]
+
+# ============ 按目录获取 ============
+_caches = {}
+_caches_lock = threading.Lock()
+
+def embedding_cache_dir(chroma_path):
+    """缓存目录: EMBED_CACHE_DIR，或 <向量数据库目录的上一级>/embedding_cache"""
+    return Path(CACHE_DIR) if CACHE_DIR else Path(chroma_path).parent / "embedding_cache"
+
+def get_embedding_cache(chroma_path):
+    """获取（并缓存）嵌入缓存，EMBED_CACHE=0 时返回 None"""
+    if not CACHE_ENABLED:
+        return None
+    directory = embedding_cache_dir(chroma_path)
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = EmbeddingCache(directory)
+        return _caches[directory]
+
+def cached_embedder(chroma_path, embedder=None):
+    """给编码器套上持久化缓存；缓存关闭时原样返回"""
+    cache = get_embedding_cache(chroma_path)
+    if cache is None or isinstance(embedder, CachedEmbedder):
+        return embedder
+    return CachedEmbedder(cache, embedder)
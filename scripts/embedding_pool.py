@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+多进程 CPU 嵌入池（全量重建索引用）
+没有 GPU 的机器上，单个进程的 BGE-M3 前向只用到一个 torch 线程池，核多了也吃不满。
+这里启动 N 个工作进程，各自加载一份模型、各自限定 intra-op 线程数，
+一批文本按长度交错切成若干分片并行编码，结果按原顺序拼回。
+工作进程只做编码，向量由调用方（唯一的写入进程）写入 Chroma，持久化存储上不会有并发写入。
+
+环境变量配置:
+    EMBED_WORKERS: 全量索引的嵌入进程数（默认 0，即不启用，在当前进程编码）
+    EMBED_THREADS: 每个嵌入进程的 intra-op 线程数（默认 CPU 核数 / 进程数）
+"""
+
+import multiprocessing
+import os
+from typing import Dict, List, Tuple
+
+# ============ 配置 ============
+EMBED_WORKERS = int(os.environ.get("EMBED_WORKERS", "0"))
+EMBED_THREADS = int(os.environ.get("EMBED_THREADS", "0"))
+SHARDS_PER_WORKER = 4  # 每个进程分到的分片数，分片小一些，快慢进程之间更均衡
+
+# ============ 工作进程 ============
+_encoder = None
+_init_error = None
+
+def _init_worker(threads):
+    """工作进程启动时限定线程数并加载模型（在 import torch 之前设置环境变量）"""
+    global _encoder, _init_error
+    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[name] = str(threads)
+    os.environ.setdefault("BGE_DEVICE", "cpu")  # 多份模型放在同一块 GPU 上没有意义
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass  # 已经执行过并行算子后不能再设置
+        from embedding_service import LocalEncoder
+        _encoder = LocalEncoder()
+    except Exception as e:
+        # 初始化函数抛异常时 Pool 会不停地重启进程，改为在任务里报错
+        _init_error = f"{type(e).__name__}: {e}"
+
+def _encode_shard(texts):
+    if _encoder is None:
+        raise RuntimeError(f"嵌入进程初始化失败: {_init_error}")
+    return _encoder.encode_with_sparse(texts)
+
+# ============ 进程池 ============
+def _shard(texts, count):
+    """
+    按长度交错分片：先按长度排序，再轮流发给各分片，每个分片的 token 总量相近
+    Returns:
+        [[原始下标...], ...]
+    """
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+    shards = [order[start::count] for start in range(count)]
+    return [shard for shard in shards if shard]
+
+class EmbeddingPool:
+    """
+    N 个各自加载模型的编码进程，接口与 BGEEmbeddingFunction.embed_documents 相同，
+    可以直接作为 index_notes(embedder=...) 传入
+    """
+    def __init__(self, workers, threads=None, log=print):
+        self.workers = max(1, workers)
+        self.threads = threads or EMBED_THREADS or max(1, (os.cpu_count() or 1) // self.workers)
+        log(f"🧵 启动 {self.workers} 个嵌入进程（每个 {self.threads} 个线程）...")
+        # spawn: 父进程已经有 Chroma/torch 的后台线程，fork 出的子进程不安全
+        context = multiprocessing.get_context("spawn")
+        self._pool = context.Pool(self.workers, initializer=_init_worker, initargs=(self.threads,))
+
+    def embed_documents(self, texts: List[str]) -> Tuple[List[List[float]], List[Dict[int, float]]]:
+        """并行编码一批文本，结果按原顺序返回"""
+        texts = list(texts)
+        if not texts:
+            return [], []
+        shards = _shard(texts, min(len(texts), self.workers * SHARDS_PER_WORKER))
+        results = self._pool.map(_encode_shard, [[texts[i] for i in shard] for shard in shards], chunksize=1)
+
+        dense = [None] * len(texts)
+        sparse = [None] * len(texts)
+        for shard, (shard_dense, shard_sparse) in zip(shards, results):
+            for j, i in enumerate(shard):
+                dense[i] = shard_dense[j]
+                sparse[i] = shard_sparse[j]
+        return dense, sparse
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._pool.terminate()
+            self._pool.join()
+        return False
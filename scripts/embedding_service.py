@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+"""
+BGE-M3 共享嵌入服务
+所有入口（indexer / server / server_http / server_cloud / api_server / build_index_cloud）
+共用这一个模块，每台机器只需常驻一份约 2GB 的模型
+
+两种用法:
+    1. 作为库: get_embedding_function() 返回进程内单例
+    2. 作为本地守护进程: python3 embedding_service.py
+       其它进程检测到 Unix socket 后自动改走守护进程，不再各自加载模型
+
+环境变量配置:
+    BGE_SOCKET: 守护进程 socket 路径（默认 ~/Documents/apple-notes-mcp/embedding.sock）
+    BGE_DAEMON: auto（默认，有守护进程就用）/ off（始终进程内加载）
+    BGE_DEVICE: 强制指定设备 cuda / mps / cpu（默认自动选择）
+    BGE_FP16: 1 / 0，是否使用半精度（默认 GPU/MPS 开启，CPU 关闭）
+    BGE_BATCH_SIZE: 单次前向的最大条数（默认 32）
+    BGE_TOKEN_BUDGET: 单次前向的 token 预算（条数 × 批内最长长度，默认 16384）
+    BGE_MAX_LENGTH: 单条文本的最大 token 数（默认 1024，索引按块切分后足够）
+    BGE_QUERY_CACHE_SIZE: 查询向量 LRU 缓存条数（默认 1024，0 关闭）
+    BGE_QUERY_CACHE_TTL: 查询向量缓存过期秒数（默认 0，不过期）
+    BGE_MAX_BATCH: 并发查询合批的最大条数（默认 16）
+    BGE_MAX_WAIT_MS: 合批时最多等待的毫秒数（默认 5，0 表示只合并已排队的请求）
+"""
+
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from chromadb.api.types import EmbeddingFunction, Documents
+
+# ============ 配置 ============
+MODEL_NAME = "BAAI/bge-m3"
+EMBEDDING_DIM = 1024
+# BGE-M3 检索不需要指令前缀；保留在查询缓存键里，换用需要指令的模型时旧缓存自动失效
+QUERY_INSTRUCTION = ""
+
+SOCKET_PATH = Path(os.environ.get(
+    "BGE_SOCKET",
+    str(Path.home() / "Documents/apple-notes-mcp/embedding.sock")
+))
+DAEMON_MODE = os.environ.get("BGE_DAEMON", "auto")
+BATCH_SIZE = int(os.environ.get("BGE_BATCH_SIZE", "32"))
+TOKEN_BUDGET = int(os.environ.get("BGE_TOKEN_BUDGET", "16384"))
+MAX_LENGTH = int(os.environ.get("BGE_MAX_LENGTH", "1024"))
+QUERY_CACHE_SIZE = int(os.environ.get("BGE_QUERY_CACHE_SIZE", "1024"))
+QUERY_CACHE_TTL = float(os.environ.get("BGE_QUERY_CACHE_TTL", "0"))
+MAX_BATCH = int(os.environ.get("BGE_MAX_BATCH", "16"))
+MAX_WAIT_MS = float(os.environ.get("BGE_MAX_WAIT_MS", "5"))
+
+# ============ 设备与精度选择 ============
+def select_device() -> str:
+    """选择推理设备：环境变量优先，其次 CUDA > MPS > CPU"""
+    forced = os.environ.get("BGE_DEVICE")
+    if forced:
+        return forced
+    try:
+        import torch
+    except ImportError:
+        return "cpu"
+    if torch.cuda.is_available():
+        return "cuda"
+    mps = getattr(torch.backends, "mps", None)
+    if mps is not None and mps.is_available():
+        return "mps"
+    return "cpu"
+
+def select_fp16(device: str) -> bool:
+    """CPU 上半精度反而更慢，只在 GPU/MPS 上启用"""
+    flag = os.environ.get("BGE_FP16")
+    if flag is not None:
+        return flag.lower() in ("1", "true", "yes")
+    return device != "cpu"
+
+# ============ 按 token 预算分批 ============
+def token_budget_batches(lengths: List[int], budget: int = TOKEN_BUDGET,
+                         max_items: int = BATCH_SIZE) -> List[List[int]]:
+    """
+    按长度降序装批，每批的 padding 后 token 数（条数 × 批内最长）不超过 budget
+    长短文本不再混在同一批里，一条长文本不会把整批都 pad 到它的长度
+
+    Args:
+        lengths: 每条文本的 token 数
+    Returns:
+        原始下标的分组列表
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches = []
+    current = []
+    width = 0  # 当前批内最长（降序装批，即第一条的长度）
+    for i in order:
+        if current and ((len(current) + 1) * width > budget or len(current) >= max_items):
+            batches.append(current)
+            current = []
+        if not current:
+            width = max(lengths[i], 1)
+        current.append(i)
+    if current:
+        batches.append(current)
+    return batches
+
+# ============ 进程内编码器 ============
+def _sparse_to_dict(weights) -> Dict[int, float]:
+    """BGE-M3 的 lexical_weights（token id 字符串 → 权重）转成 {int: float}"""
+    return {int(token): float(weight) for token, weight in weights.items()}
+
+class LocalEncoder:
+    """
+    在当前进程加载 BGE-M3（BGEM3FlagModel）
+    同一次前向同时输出稠密向量和稀疏词权重（lexical weights）
+    模型前向不是线程安全的，用锁串行化
+    """
+    def __init__(self):
+        from FlagEmbedding import BGEM3FlagModel
+
+        self.device = select_device()
+        self.use_fp16 = select_fp16(self.device)
+        print(
+            f"🚀 加载 BGE-M3 模型（设备: {self.device}, fp16: {self.use_fp16}，"
+            "首次加载会下载约2GB模型文件）...",
+            file=sys.stderr
+        )
+        try:
+            # FlagEmbedding >= 1.3 用 devices 参数
+            self.model = BGEM3FlagModel(MODEL_NAME, use_fp16=self.use_fp16, devices=self.device)
+        except TypeError:
+            # 1.2.x 用 device 参数
+            self.model = BGEM3FlagModel(MODEL_NAME, use_fp16=self.use_fp16, device=self.device)
+        self._lock = threading.Lock()
+        print("✅ BGE-M3 模型加载完成", file=sys.stderr)
+
+    def _token_lengths(self, texts):
+        """分词得到每条文本的 token 数（截断到 MAX_LENGTH）"""
+        encoded = self.model.tokenizer(
+            list(texts),
+            add_special_tokens=True,
+            truncation=True,
+            max_length=MAX_LENGTH
+        )
+        return [len(ids) for ids in encoded["input_ids"]]
+
+    def _encode(self, texts, return_sparse):
+        """
+        按 token 预算分批前向，结果按原顺序返回
+        每批单独加锁，索引大批量文本时查询请求可以插在批次之间
+        """
+        if len(texts) == 1:
+            batches = [[0]]  # 单条查询不必先分词
+        else:
+            batches = token_budget_batches(self._token_lengths(texts))
+
+        dense = [None] * len(texts)
+        sparse = [None] * len(texts) if return_sparse else None
+        for batch in batches:
+            with self._lock:
+                output = self.model.encode(
+                    [texts[i] for i in batch],
+                    batch_size=len(batch),
+                    max_length=MAX_LENGTH,
+                    return_dense=True,
+                    return_sparse=return_sparse,
+                    return_colbert_vecs=False
+                )
+            for j, i in enumerate(batch):
+                dense[i] = output["dense_vecs"][j].tolist()
+                if return_sparse:
+                    sparse[i] = _sparse_to_dict(output["lexical_weights"][j])
+        return dense, sparse
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        """只要稠密向量"""
+        if not texts:
+            return []
+        return self._encode(texts, return_sparse=False)[0]
+
+    def encode_with_sparse(self, texts: List[str]) -> Tuple[List[List[float]], List[Dict[int, float]]]:
+        """稠密向量 + 稀疏词权重，一次前向"""
+        if not texts:
+            return [], []
+        return self._encode(texts, return_sparse=True)
+
+# ============ 守护进程客户端 ============
+def _recv_line(sock: socket.socket) -> bytes:
+    """读取一行（以 \\n 结尾）的响应"""
+    chunks = []
+    while True:
+        chunk = sock.recv(1 << 16)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b"\n"):
+            break
+    return b"".join(chunks)
+
+def _request(path: Path, payload: dict, timeout: Optional[float] = None) -> dict:
+    """向守护进程发送一条 JSON 请求并读取 JSON 响应"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(path))
+        sock.sendall(json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n")
+        raw = _recv_line(sock)
+    if not raw:
+        raise ConnectionError("嵌入服务未返回数据")
+    response = json.loads(raw)
+    if "error" in response:
+        raise RuntimeError(f"嵌入服务错误: {response['error']}")
+    return response
+
+def daemon_available(path: Path = SOCKET_PATH) -> bool:
+    """检测守护进程是否在线"""
+    if not path.exists():
+        return False
+    try:
+        return _request(path, {"op": "ping"}, timeout=2).get("model") == MODEL_NAME
+    except (OSError, ValueError, RuntimeError):
+        return False
+
+class RemoteEncoder:
+    """
+    通过 Unix socket 调用本机守护进程
+    守护进程掉线时退回进程内加载，保证搜索不中断
+    """
+    def __init__(self, path: Path = SOCKET_PATH):
+        self.path = path
+        self._fallback = None
+        print(f"🔌 使用嵌入服务守护进程: {path}", file=sys.stderr)
+
+    def _call(self, op, texts):
+        """发送请求；守护进程不可用时返回 None"""
+        if self._fallback is not None:
+            return None
+        try:
+            return _request(self.path, {"op": op, "texts": list(texts)})
+        except (OSError, ConnectionError) as e:
+            print(f"⚠️  嵌入服务不可用 ({e})，改为进程内加载模型", file=sys.stderr)
+            self._fallback = LocalEncoder()
+            return None
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        response = self._call("encode", texts)
+        if response is None:
+            return self._fallback.encode(texts)
+        return response["embeddings"]
+
+    def encode_with_sparse(self, texts: List[str]) -> Tuple[List[List[float]], List[Dict[int, float]]]:
+        if not texts:
+            return [], []
+        response = self._call("encode_sparse", texts)
+        if response is None:
+            return self._fallback.encode_with_sparse(texts)
+        # JSON 的键是字符串，还原为 token id
+        return response["embeddings"], [_sparse_to_dict(weights) for weights in response["sparse"]]
+
+# ============ 并发查询合批 ============
+class EncodeBatcher:
+    """
+    请求合并器：把几毫秒内到达的单条编码请求合成一次 encode
+    CPU 上单条编码浪费了大部分矩阵乘吞吐，多客户端并发时合批能明显提高 QPS
+    """
+    def __init__(self, encoder, max_batch: int = MAX_BATCH, max_wait_ms: float = MAX_WAIT_MS):
+        self.encoder = encoder
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def encode_one(self, text: str) -> Tuple[List[float], Dict[int, float]]:
+        """提交单条文本，阻塞直到所在批次编码完成，返回 (稠密向量, 稀疏词权重)"""
+        future = Future()
+        self._queue.put((text, future))
+        self._ensure_worker()
+        return future.result()
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="bge-batcher", daemon=True
+                )
+                self._worker.start()
+
+    def _collect(self):
+        """取第一条请求后，在 max_wait 内继续收集，直到凑满 max_batch"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # 同一批里的重复文本只编码一次
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                vectors = dict(zip(texts, zip(*self.encoder.encode_with_sparse(texts))))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for text, future in batch:
+                future.set_result(vectors[text])
+
+# ============ 查询向量缓存 ============
+def normalize_query(text: str) -> str:
+    """规范化查询文本：NFKC（全角转半角等）+ 合并空白，不改变语义"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+class QueryEmbeddingCache:
+    """
+    查询向量 LRU 缓存（可选 TTL），缓存 (稠密向量, 稀疏词权重)
+    键包含模型和指令前缀，换模型或换指令后旧向量自动失效
+    """
+    def __init__(self, maxsize: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                stored_at, vector = entry
+                if not self.ttl or time.monotonic() - stored_at < self.ttl:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return vector
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, vector):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), vector)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0
+            }
+
+# ============ Chroma 嵌入函数 ============
+class BGEEmbeddingFunction(EmbeddingFunction):
+    """
+    BGE-M3 嵌入函数
+    使用 BAAI/bge-m3 模型生成 1024 维向量
+    - 模型: BAAI/bge-m3
+    - 维度: 1024
+    - 特点: 优化中英文混合搜索，支持 100+ 语言
+    """
+    def __init__(self, encoder=None):
+        self.encoder = encoder if encoder is not None else LocalEncoder()
+        self.query_cache = QueryEmbeddingCache()
+        self.batcher = EncodeBatcher(self.encoder)
+
+    def __call__(self, input: Documents) -> List[List[float]]:
+        """
+        将文本转换为向量
+        Args:
+            input: 文本列表
+        Returns:
+            向量列表（每个向量 1024 维）
+        """
+        return self.encoder.encode(list(input))
+
+    def embed_documents(self, texts: List[str]) -> Tuple[List[List[float]], List[Dict[int, float]]]:
+        """编码待索引的文档，一次前向同时返回稠密向量和稀疏词权重"""
+        return self.encoder.encode_with_sparse(list(texts))
+
+    def embed_query_with_sparse(self, query: str) -> Tuple[List[float], Dict[int, float]]:
+        """
+        编码单条查询（带缓存），重复查询不经过模型
+        Returns:
+            (稠密向量, 稀疏词权重)
+        """
+        text = normalize_query(query)
+        key = (MODEL_NAME, QUERY_INSTRUCTION, text)
+        entry = self.query_cache.get(key)
+        if entry is None:
+            entry = self.batcher.encode_one(text)
+            self.query_cache.put(key, entry)
+        return entry
+
+    def embed_query(self, query: str) -> List[float]:
+        """
+        只取查询的稠密向量
+        配合 collection.query(query_embeddings=[...]) 使用
+        """
+        return self.embed_query_with_sparse(query)[0]
+
+# ============ 进程内单例 ============
+_shared_ef = None
+_shared_lock = threading.Lock()
+
+def get_embedding_function() -> BGEEmbeddingFunction:
+    """
+    获取共享嵌入函数（每个进程只创建一次）
+    有守护进程时走 socket，否则在本进程加载模型
+    """
+    global _shared_ef
+    with _shared_lock:
+        if _shared_ef is None:
+            if DAEMON_MODE != "off" and daemon_available():
+                encoder = RemoteEncoder()
+            else:
+                encoder = LocalEncoder()
+            _shared_ef = BGEEmbeddingFunction(encoder)
+    return _shared_ef
+
+class LazyEmbeddingFunction(EmbeddingFunction):
+    """
+    打开 collection 用的嵌入函数：Chroma 真正需要编码时才获取共享嵌入函数（加载模型）
+    索引流程写入时总是自带向量，全部命中嵌入缓存的重建不会加载模型
+    """
+    def __init__(self):
+        pass  # 新版 Chroma 要求嵌入函数显式定义 __init__
+
+    def __call__(self, input: Documents) -> List[List[float]]:
+        return get_embedding_function()(input)
+
+# ============ 守护进程 ============
+class _EmbeddingRequestHandler(socketserver.StreamRequestHandler):
+    """每个连接按行读取 JSON 请求"""
+    def handle(self):
+        for raw in self.rfile:
+            try:
+                request = json.loads(raw)
+                op = request.get("op")
+                if op == "ping":
+                    response = {"model": MODEL_NAME, "dim": EMBEDDING_DIM}
+                elif op == "encode":
+                    response = {"embeddings": self.server.encoder.encode(request["texts"])}
+                elif op == "encode_sparse":
+                    texts = request["texts"]
+                    if len(texts) == 1:
+                        # 单条查询走合批，多个客户端同时查询时合成一次前向
+                        dense, sparse = self.server.batcher.encode_one(texts[0])
+                        response = {"embeddings": [dense], "sparse": [sparse]}
+                    else:
+                        dense, sparse = self.server.encoder.encode_with_sparse(texts)
+                        response = {"embeddings": dense, "sparse": sparse}
+                else:
+                    response = {"error": f"未知操作: {op}"}
+            except Exception as e:
+                response = {"error": str(e)}
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+class _EmbeddingServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+def serve(path: Path = SOCKET_PATH):
+    """启动守护进程，模型在本进程加载一次，供本机所有入口共享"""
+    if daemon_available(path):
+        print(f"⚠️  嵌入服务已在运行: {path}", file=sys.stderr)
+        return
+    if path.exists():
+        path.unlink()  # 清理上次异常退出残留的 socket
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    encoder = LocalEncoder()
+    server = _EmbeddingServer(str(path), _EmbeddingRequestHandler)
+    server.encoder = encoder
+    server.batcher = EncodeBatcher(encoder)
+    os.chmod(path, 0o600)  # 只允许当前用户访问
+    print(f"✅ 嵌入服务已启动: {path}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if path.exists():
+            path.unlink()
+        print("👋 嵌入服务已停止", file=sys.stderr)
+
+# ============ 主函数 ============
+if __name__ == "__main__":
+    serve()
@@ -3,18 +3,35 @@
 修复版的 Apple Notes 导出脚本
 原始工具使用 mac_roman 编码，导致中文乱码
 这个版本使用正确的 UTF-8 编码
+
+默认两阶段增量导出：先列出所有笔记的 id 和修改时间（不读正文），
+与 notes.db 对比后只取新增或修改笔记的正文，并删除已不存在的笔记。
+
+用法:
+    python3 export_notes_fixed.py          # 增量导出
+    python3 export_notes_fixed.py --full   # 全量导出所有正文
+    python3 export_notes_fixed.py bench [笔记数] [每条KB]  # 解析速度基准
 """
 
+import codecs
+import hashlib
+import os
 import subprocess
 import sqlite3
 import secrets
+import sys
+import time
 from pathlib import Path
 
 NOTES_DB = Path.home() / "notes.db"
 
-EXTRACT_SCRIPT = """
-tell application "Notes"
-   repeat with eachNote in every note
+FETCH_CHUNK = 200  # 增量导出时每次 osascript 调用取正文的笔记数
+WRITE_BATCH = 200  # 每次 executemany 写入的笔记数
+READ_BLOCK = 1 << 20  # 解析 osascript 输出时每次读取的字节数
+NOTE_FIELDS = ("id", "title", "created", "updated")
+
+# 每条笔记输出的字段（全量导出和按 id 导出共用）
+_LOG_NOTE = """
       set noteId to the id of eachNote
       set noteTitle to the name of eachNote
       set noteBody to the body of eachNote
@@ -28,97 +45,366 @@ tell application "Notes"
       log "{split}-title: " & noteTitle & "\\n\\n"
       log noteBody & "\\n"
       log "{split}{split}" & "\\n"
+"""
+
+EXTRACT_SCRIPT = ("""
+tell application "Notes"
+   repeat with eachNote in every note
+""" + _LOG_NOTE + """
+   end repeat
+end tell
+""").strip()
+
+# 第一阶段：只列出 id 和修改时间（批量取属性，不读正文）
+LIST_SCRIPT = """
+tell application "Notes"
+   set noteIds to the id of every note
+   set noteDates to the modification date of every note
+   repeat with i from 1 to count of noteIds
+      set noteUpdated to ((item i of noteDates) as «class isot» as string)
+      log "{split}-item: " & (item i of noteIds) & "{split}" & noteUpdated
    end repeat
 end tell
 """.strip()
 
-def extract_notes():
-    """使用 UTF-8 编码导出备忘录"""
-    split = secrets.token_hex(8)
+# 第二阶段：只取新增或修改笔记的正文
+FETCH_SCRIPT = ("""
+tell application "Notes"
+   repeat with wantedId in {ids}
+      set eachNote to note id (contents of wantedId)
+""" + _LOG_NOTE + """
+   end repeat
+end tell
+""").strip()
+
+def _iter_text(stream):
+    """
+    按大块读取字节流并增量解码为文本块
+    有状态解码器保证跨块的多字节 UTF-8 字符正确拼接，坏字节替换为 U+FFFD 而不是丢掉整行
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    read = getattr(stream, "read1", None) or getattr(stream, "read", None)
+    if read is not None:
+        # 管道上 read1 有多少读多少，不必等满一整块，导出仍是流式的
+        for block in iter(lambda: read(READ_BLOCK), b""):
+            yield decoder.decode(block)
+    else:
+        for block in stream:
+            yield decoder.decode(block)
+    yield decoder.decode(b"", final=True)
+
+def parse_notes(stream, split):
+    """
+    解析 osascript 输出，逐条产出笔记
+    与 osascript 进程解耦，可以直接喂录制好的输出（在 Linux 上测试）
+
+    单遍扫描：只用 str.find 查找随机分隔符，两个标记之间的文本整段视为正文，
+    不逐行解码、不逐行匹配前缀；正文以大段切片收集，结束时拼接一次
+
+    Args:
+        stream: 二进制文件对象（如 process.stdout 或打开的录制文件），或字节块的可迭代对象
+        split: 导出脚本使用的分隔符
+    """
+    marker_len = len(split)
+    note = {}
+    body = []
+    buf = ""
+
+    for text in _iter_text(stream):
+        buf += text
+        pos = 0
+        while True:
+            idx = buf.find(split, pos)
+            if idx < 0:
+                # 没有完整的标记：末尾可能是被截断的标记，留到下一块
+                keep = max(pos, len(buf) - marker_len + 1)
+                if note and keep > pos:
+                    body.append(buf[pos:keep])
+                buf = buf[keep:]
+                break
 
-    # 运行 AppleScript
+            end = buf.find("\n", idx)
+            if end < 0:
+                # 标记行还没读完整
+                if note and idx > pos:
+                    body.append(buf[pos:idx])
+                buf = buf[idx:]
+                break
+
+            if note and idx > pos:
+                body.append(buf[pos:idx])
+            line = buf[idx + marker_len:end].strip()
+            pos = end + 1
+
+            if line == split:
+                # 笔记分隔符
+                if note.get("id"):
+                    note["body"] = "".join(body).strip()
+                    yield note
+                note = {}
+                body = []
+            elif line.startswith("-"):
+                # 字段行: -key: value
+                key, _, value = line[1:].partition(":")
+                if key in NOTE_FIELDS:
+                    note[key] = value.strip()
+
+def parse_listing(stream, split):
+    """
+    解析第一阶段的输出
+    Returns:
+        {笔记 id: 修改时间}
+    """
+    prefix = f"{split}-item: "
+    listing = {}
+    for line in "".join(_iter_text(stream)).splitlines():
+        line = line.strip()
+        if not line.startswith(prefix):
+            continue
+        note_id, _, updated = line[len(prefix):].rpartition(split)
+        if note_id:
+            listing[note_id] = updated
+    return listing
+
+def run_osascript(script):
+    """运行 AppleScript，按块产出输出（字节）；退出码非 0 时抛出异常"""
     process = subprocess.Popen(
-        ["osascript", "-e", EXTRACT_SCRIPT.format(split=split)],
+        ["osascript", "-e", script],
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
     )
+    try:
+        yield from iter(lambda: process.stdout.read1(READ_BLOCK), b"")
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise RuntimeError(f"osascript 退出码 {returncode}")
 
-    note = {}
-    body = []
+def _applescript_list(values):
+    """Python 字符串列表转 AppleScript 列表字面量"""
+    quoted = ('"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"' for value in values)
+    return "{" + ", ".join(quoted) + "}"
 
-    for line in process.stdout:
-        # 使用 UTF-8 而不是 mac_roman！
-        try:
-            line = line.decode("utf-8").strip()
-        except UnicodeDecodeError:
-            # 如果 UTF-8 失败，尝试 UTF-16
-            try:
-                line = line.decode("utf-16").strip()
-            except:
-                # 实在不行就跳过这行
-                continue
+def extract_notes(ids=None, runner=run_osascript):
+    """
+    使用 UTF-8 编码导出备忘录（边导出边产出，不等 osascript 结束）
 
-        # 检查是否是笔记分隔符
-        if line == f"{split}{split}":
-            if note.get("id"):
-                note["body"] = "\\n".join(body).strip()
-                yield note
-            note = {}
-            body = []
-            continue
+    Args:
+        ids: 只导出这些笔记（None 表示全部）
+        runner: 执行 AppleScript 并返回输出行的函数（测试时可替换为假的 runner）
+    """
+    split = secrets.token_hex(8)
+    if ids is None:
+        yield from parse_notes(runner(EXTRACT_SCRIPT.format(split=split)), split)
+        return
+    ids = list(ids)
+    for i in range(0, len(ids), FETCH_CHUNK):
+        script = FETCH_SCRIPT.format(split=split, ids=_applescript_list(ids[i:i+FETCH_CHUNK]))
+        yield from parse_notes(runner(script), split)
+
+def list_notes(runner=run_osascript):
+    """第一阶段：列出所有笔记的 id 和修改时间"""
+    split = secrets.token_hex(8)
+    return parse_listing(runner(LIST_SCRIPT.format(split=split)), split)
+
+def diff_listing(listing, stored):
+    """
+    对比 Apple Notes 的 id/修改时间 与 notes.db
+    Args:
+        listing: {id: 修改时间}，来自 list_notes()
+        stored: {id: 修改时间}，来自 stored_versions()
+    Returns:
+        (需要导出正文的 id 列表, 已删除的 id 列表)
+    """
+    changed = [note_id for note_id, updated in listing.items() if stored.get(note_id) != updated]
+    deleted = [note_id for note_id in stored if note_id not in listing]
+    return changed, deleted
+
+def export_changes(conn, runner=run_osascript):
+    """
+    两阶段增量导出：先列出 id/修改时间，再只取新增或修改笔记的正文
+
+    Returns:
+        (变更笔记的迭代器, 已删除的 id 列表)
+    """
+    listing = list_notes(runner)
+    if not listing:
+        # Notes 没有返回任何笔记时不能据此删除，按出错处理
+        raise RuntimeError("Apple Notes 没有返回任何笔记")
+    changed, deleted = diff_listing(listing, stored_versions(conn))
+    return extract_notes(changed, runner) if changed else iter(()), deleted
+
+# ============ 写入 notes.db ============
+_NOTES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notes (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    body TEXT,
+    created TEXT,
+    updated TEXT
+);
+CREATE TABLE IF NOT EXISTS note_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT,
+    kind TEXT
+);
+"""
+
+def open_notes_db(path=NOTES_DB):
+    """
+    打开（必要时创建）notes.db
+    WAL 模式：导出写入时索引和服务器照常读取
+    note_changes 是变更日志（kind 为 upsert / delete），索引脚本据此增量索引
+    """
+    conn = sqlite3.connect(str(path))
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_NOTES_SCHEMA)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(notes)")}
+    if "content_hash" not in columns:
+        # 旧版数据库没有哈希列，下次导出时整行重写一次
+        conn.execute("ALTER TABLE notes ADD COLUMN content_hash TEXT")
+    return conn
+
+def stored_versions(conn):
+    """notes.db 中每条笔记的修改时间 {id: 修改时间}"""
+    return dict(conn.execute("SELECT id, updated FROM notes"))
+
+def delete_notes(conn, ids):
+    """删除已不在 Apple Notes 中的笔记并记入变更日志（由调用方提交事务）"""
+    rows = [(note_id,) for note_id in ids]
+    conn.executemany("DELETE FROM notes WHERE id = ?", rows)
+    conn.executemany("INSERT INTO note_changes (id, kind) VALUES (?, 'delete')", rows)
+
+def note_hash(note):
+    """整行内容（标题、正文、时间）的哈希，相同则不重写"""
+    digest = hashlib.sha256()
+    for key in ("title", "body", "created", "updated"):
+        digest.update((note.get(key) or "").encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+class NoteWriter:
+    """
+    批量写入笔记: 攒满一批后一次 executemany + 一次提交
+    内容哈希与库中相同的行跳过，真正变化的 id 记入 note_changes
+    """
+    def __init__(self, conn, batch_size=WRITE_BATCH):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.pending = []
+        self.written = 0
+        self.skipped = 0
+
+    def add(self, note):
+        """
+        加入一条笔记，攒满一批时写入
+        Returns:
+            本次写入的变化笔记列表（未触发写入时为空）
+        """
+        self.pending.append(note)
+        if len(self.pending) >= self.batch_size:
+            return self.flush()
+        return []
 
-        # 解析笔记字段
-        found_key = False
-        for key in ("id", "title", "created", "updated"):
-            if line.startswith(f"{split}-{key}: "):
-                note[key] = line[len(f"{split}-{key}: "):]
-                found_key = True
+    def flush(self):
+        """写入缓冲的笔记，返回内容有变化的笔记"""
+        if not self.pending:
+            return []
+        batch = {note["id"]: note for note in self.pending}  # 同一批内重复的 id 取最后一次
+        self.pending = []
+
+        placeholders = ",".join("?" * len(batch))
+        stored = dict(self.conn.execute(
+            f"SELECT id, content_hash FROM notes WHERE id IN ({placeholders})",
+            list(batch)
+        ))
+        changed = []
+        rows = []
+        for note_id, note in batch.items():
+            digest = note_hash(note)
+            if stored.get(note_id) == digest:
                 continue
+            changed.append(note)
+            rows.append((note_id, note.get("title"), note.get("body"),
+                         note.get("created"), note.get("updated"), digest))
+
+        with self.conn:
+            self.conn.executemany("""
+                INSERT OR REPLACE INTO notes (id, title, body, created, updated, content_hash)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, rows)
+            self.conn.executemany(
+                "INSERT INTO note_changes (id, kind) VALUES (?, 'upsert')",
+                [(row[0],) for row in rows]
+            )
+        self.written += len(rows)
+        self.skipped += len(batch) - len(rows)
+        return changed
+
+def pending_changes(conn):
+    """
+    读取变更日志
+    Returns:
+        (最大序号, 有变化的 id 集合, 已删除的 id 集合)；日志为空时最大序号为 0
+    """
+    upserts, deletes = set(), set()
+    last_seq = 0
+    for seq, note_id, kind in conn.execute("SELECT seq, id, kind FROM note_changes ORDER BY seq"):
+        last_seq = seq
+        # 以最后一次变更为准
+        if kind == "delete":
+            upserts.discard(note_id)
+            deletes.add(note_id)
+        else:
+            deletes.discard(note_id)
+            upserts.add(note_id)
+    return last_seq, upserts, deletes
 
-        if not found_key:
-            body.append(line)
+def clear_changes(conn, last_seq, retry=()):
+    """
+    索引后清除已处理的变更日志
+    retry 中的笔记（索引失败的）在同一事务里重新记入日志，下次索引时重试
+    """
+    with conn:
+        conn.execute("DELETE FROM note_changes WHERE seq <= ?", (last_seq,))
+        conn.executemany(
+            "INSERT INTO note_changes (id, kind) VALUES (?, 'upsert')",
+            [(note_id,) for note_id in retry]
+        )
 
-def main():
+def main(full=False):
     print("=" * 60)
     print("📤 导出 Apple Notes (UTF-8 修复版)")
     print("=" * 60)
 
     # 创建数据库
-    conn = sqlite3.connect(str(NOTES_DB))
-    cursor = conn.cursor()
-
-    # 创建表（如果不存在）
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS notes (
-            id TEXT PRIMARY KEY,
-            title TEXT,
-            body TEXT,
-            created TEXT,
-            updated TEXT
-        )
-    """)
+    conn = open_notes_db()
+
+    if full:
+        notes = extract_notes()
+    else:
+        # 默认增量：只取新增或修改笔记的正文，并删除已不存在的笔记
+        notes, deleted = export_changes(conn)
+        delete_notes(conn, deleted)
+        if deleted:
+            print(f"🗑️  删除已不存在的笔记: {len(deleted)} 条")
 
+    writer = NoteWriter(conn)
     count = 0
-    for note in extract_notes():
-        # 插入或更新笔记
-        cursor.execute("""
-            INSERT OR REPLACE INTO notes (id, title, body, created, updated)
-            VALUES (?, ?, ?, ?, ?)
-        """, (
-            note.get("id"),
-            note.get("title"),
-            note.get("body"),
-            note.get("created"),
-            note.get("updated")
-        ))
+    for note in notes:
+        # 攒批写入，内容未变化的行不重写
+        writer.add(note)
         count += 1
         if count % 50 == 0:
             print(f"✓ 已导出 {count} 条笔记...")
+    writer.flush()
 
     conn.commit()
     conn.close()
 
-    print(f"\\n✅ 导出完成！共 {count} 条笔记")
+    print(f"\\n✅ 导出完成！共 {count} 条笔记（写入 {writer.written} 条，未变化 {writer.skipped} 条）")
 
     # 显示几个笔记标题验证编码
     print("\\n📝 验证编码（前5条标题）:")
@@ -128,5 +414,50 @@ def main():
         print(f"  {i}. {title[:50]}")
     conn.close()
 
+# ============ 解析基准测试 ============
+def _write_transcript(path, notes, body_kb, split):
+    """生成模拟的 osascript 输出：notes 条笔记，每条正文约 body_kb KB"""
+    paragraph = "<div>会议纪要 meeting notes 第二季度预算与 RTX-4090 采购计划</div>\n"
+    body = paragraph * max(1, body_kb * 1024 // len(paragraph.encode("utf-8")))
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(notes):
+            f.write(f"{split}-id: x-coredata://note/{i}\n\n")
+            f.write(f"{split}-created: 2024-01-01T08:00:00\n\n")
+            f.write(f"{split}-updated: 2024-03-01T08:00:00\n\n")
+            f.write(f"{split}-title: 笔记 {i}\n\n\n")
+            f.write(body)
+            f.write(f"\n{split}{split}\n\n")
+
+def bench(notes=10000, body_kb=50):
+    """解析速度基准：默认 1 万条笔记、约 500MB 的模拟输出"""
+    import resource
+    import tempfile
+
+    split = secrets.token_hex(8)
+    fd, path = tempfile.mkstemp(suffix=".txt")
+    os.close(fd)
+    try:
+        print(f"📝 生成模拟输出: {notes} 条笔记 × {body_kb}KB ...")
+        _write_transcript(path, notes, body_kb, split)
+        size_mb = os.path.getsize(path) / 1024 / 1024
+
+        start = time.perf_counter()
+        count = 0
+        with open(path, "rb") as f:
+            for _ in parse_notes(f, split):
+                count += 1
+        elapsed = time.perf_counter() - start
+
+        # macOS 上 ru_maxrss 单位是字节，Linux 上是 KB
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_mb = peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+        print(f"✅ 解析 {count} 条笔记，{size_mb:.0f}MB，用时 {elapsed:.2f}s "
+              f"({size_mb / elapsed:.0f} MB/s)，峰值内存 {peak_mb:.0f}MB")
+    finally:
+        os.unlink(path)
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        bench(*(int(arg) for arg in sys.argv[2:4]))
+    else:
+        main(full="--full" in sys.argv[1:])
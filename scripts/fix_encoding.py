@@ -3,12 +3,28 @@
 修复 apple-notes-to-sqlite 导出的编码问题
 问题: apple-notes-to-sqlite 使用 UTF-8 字节但被错误解释为 Latin-1
 解决: 将文本编码回 Latin-1 字节，然后正确解码为 UTF-8
+
+流式修复，内存占用与笔记库大小无关:
+1. SQL 预筛选: GLOB 只取出含有「UTF-8 首字节 + 续字节」形态 Latin-1 字符的行
+2. 按主键分块读取（keyset 分页），每块修复后 executemany 批量写回
+3. 整个修复在一个事务里完成，中途出错不会留下改了一半的库
+
+用法:
+    python3 fix_encoding.py            # 修复
+    python3 fix_encoding.py --dry-run  # 只报告受影响的行，不写入
 """
 
+import re
 import sqlite3
+import sys
 from pathlib import Path
 
 NOTES_DB = Path.home() / "notes.db"
+CHUNK_SIZE = 500  # 每次读取的候选行数
+
+# UTF-8 多字节序列被当成 Latin-1 后的样子：首字节 0xC2-0xF4 后跟续字节 0x80-0xBF
+MOJIBAKE_GLOB = "*[Â-ô][\u0080-¿]*"
+_MOJIBAKE_RE = re.compile("[Â-ô][\u0080-¿]")
 
 def fix_encoding(text):
     """
@@ -18,28 +34,72 @@ def fix_encoding(text):
 
     修复方法：
     1. 将错误的Unicode字符编码回Latin-1字节
-    2. 用UTF-8重新解码这些字节
+    2. 用UTF-8重新解码这些字节（严格模式）
+
+    不是乱码的文本原样返回：含非 Latin-1 字符（如已经正确的中文），
+    或回退后不是合法 UTF-8（如正常的 "café"）
     """
-    if not text:
+    if not text or not _MOJIBAKE_RE.search(text):
         return text
-
     try:
-        # 将错误解释的字符编码回原始字节
-        # 然后用UTF-8正确解码
-        fixed = text.encode('latin-1').decode('utf-8', errors='replace')
-        return fixed
-    except Exception as e:
-        # 如果转换失败，说明可能已经是正确编码或是纯英文
-        # 尝试直接返回或使用NFD标准化
-        try:
-            import unicodedata
-            return unicodedata.normalize('NFC', text)
-        except:
-            return text
-
-def main():
+        return text.encode('latin-1').decode('utf-8')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return text
+
+def iter_candidates(conn, chunk_size=CHUNK_SIZE):
+    """
+    按主键分块读取可能是乱码的行（标题或正文命中 GLOB 预筛选）
+    每次只有一块在内存里
+    """
+    last_id = ""
+    while True:
+        rows = conn.execute("""
+            SELECT id, title, body FROM notes
+            WHERE id > ? AND (title GLOB ? OR body GLOB ?)
+            ORDER BY id
+            LIMIT ?
+        """, (last_id, MOJIBAKE_GLOB, MOJIBAKE_GLOB, chunk_size)).fetchall()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+def repair(conn, dry_run=False, report=print, chunk_size=CHUNK_SIZE):
+    """
+    流式修复 notes 表
+    Returns:
+        (预筛选命中的行数, 实际修复的行数)
+    """
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    journal = "note_changes" in tables  # 导出脚本的变更日志，修复的笔记需要重新索引
+
+    scanned = 0
+    fixed_count = 0
+    for rows in iter_candidates(conn, chunk_size):
+        scanned += len(rows)
+        updates = []
+        for note_id, title, body in rows:
+            fixed_title = fix_encoding(title)
+            fixed_body = fix_encoding(body)
+            if fixed_title != title or fixed_body != body:
+                updates.append((fixed_title, fixed_body, note_id))
+                if dry_run:
+                    report(f"  - {note_id}: {(title or '')[:30]!r} → {(fixed_title or '')[:30]!r}")
+        fixed_count += len(updates)
+        if updates and not dry_run:
+            conn.executemany("UPDATE notes SET title = ?, body = ? WHERE id = ?", updates)
+            if journal:
+                conn.executemany(
+                    "INSERT INTO note_changes (id, kind) VALUES (?, 'upsert')",
+                    [(note_id,) for _, _, note_id in updates]
+                )
+    if not dry_run:
+        conn.commit()
+    return scanned, fixed_count
+
+def main(dry_run=False):
     print("=" * 60)
-    print("🔧 修复备忘录编码")
+    print("🔧 修复备忘录编码" + ("（试运行）" if dry_run else ""))
     print("=" * 60)
 
     if not NOTES_DB.exists():
@@ -47,30 +107,21 @@ def main():
         return
 
     conn = sqlite3.connect(str(NOTES_DB))
+    total = conn.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+    print(f"📊 发现 {total} 条笔记")
 
-    # 获取所有笔记
-    cursor = conn.execute("SELECT id, title, body FROM notes")
-    notes = cursor.fetchall()
-
-    print(f"📊 发现 {len(notes)} 条笔记")
-
-    fixed_count = 0
-    for note_id, title, body in notes:
-        # 修复标题和内容
-        fixed_title = fix_encoding(title) if title else title
-        fixed_body = fix_encoding(body) if body else body
-
-        # 如果有变化，更新数据库
-        if fixed_title != title or fixed_body != body:
-            conn.execute(
-                "UPDATE notes SET title = ?, body = ? WHERE id = ?",
-                (fixed_title, fixed_body, note_id)
-            )
-            fixed_count += 1
-
-    conn.commit()
-    conn.close()
-
+    try:
+        scanned, fixed_count = repair(conn, dry_run=dry_run)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    print(f"🔍 预筛选命中 {scanned} 条")
+    if dry_run:
+        print(f"📝 将修复 {fixed_count} 条笔记（未写入）")
+        return
     print(f"✅ 修复完成！共修复 {fixed_count} 条笔记")
 
     # 显示几个修复后的标题作为验证
@@ -82,4 +133,4 @@ def main():
     conn.close()
 
 if __name__ == "__main__":
-    main()
+    main(dry_run="--dry-run" in sys.argv[1:])
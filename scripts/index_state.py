@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+索引状态文件
+索引代数（generation）: 每次索引写入后加一，服务器据此判断缓存是否过期。
+collection 别名: 当前提供服务的 collection 名（apple_notes_v{n}），全量重建完成后原子切换；
+    切换下来的旧版本记入待回收列表，过了宽限期再删除。
+重建断点: 全量重建已处理到的位置，中断后从这里继续。
+状态文件放在向量数据库目录旁边，索引脚本和各个服务器进程共享。
+"""
+
+import fcntl
+import json
+import os
+from pathlib import Path
+
+DEFAULT_COLLECTION = "apple_notes"
+
+def _write_atomic(path: Path, text: str):
+    """写临时文件再原子替换，读者不会读到写了一半的内容"""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+# ============ 索引代数 ============
+def generation_file(chroma_path) -> Path:
+    """代数文件路径：<向量数据库目录的上一级>/.index_generation"""
+    return Path(chroma_path).parent / ".index_generation"
+
+def read_generation(chroma_path) -> int:
+    """读取当前索引代数，文件不存在时为 0"""
+    try:
+        return int(generation_file(chroma_path).read_text().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def bump_generation(chroma_path) -> int:
+    """
+    索引代数加一（跨进程加锁 + 原子替换）
+    Returns:
+        新的代数
+    """
+    path = generation_file(chroma_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        generation = read_generation(chroma_path) + 1
+        _write_atomic(path, str(generation))
+    return generation
+
+class GenerationWatcher:
+    """
+    读取索引代数，只在文件变化（mtime/size）时重新读取
+    查询热路径上只有一次 stat 调用
+    """
+    def __init__(self, chroma_path):
+        self.chroma_path = chroma_path
+        self._signature = None
+        self._generation = 0
+
+    def current(self) -> int:
+        try:
+            st = generation_file(self.chroma_path).stat()
+            signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except FileNotFoundError:
+            signature = None
+        if signature != self._signature:
+            self._generation = read_generation(self.chroma_path)
+            self._signature = signature
+        return self._generation
+
+# ============ collection 别名 ============
+def alias_file(chroma_path) -> Path:
+    """别名文件路径：<向量数据库目录的上一级>/.collection_alias"""
+    return Path(chroma_path).parent / ".collection_alias"
+
+def read_alias(chroma_path) -> str:
+    """当前提供服务的 collection 名，别名文件不存在时为 apple_notes"""
+    try:
+        return alias_file(chroma_path).read_text().strip() or DEFAULT_COLLECTION
+    except FileNotFoundError:
+        return DEFAULT_COLLECTION
+
+def write_alias(chroma_path, name):
+    """把别名指向新的 collection（原子替换）"""
+    path = alias_file(chroma_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _write_atomic(path, name)
+
+class AliasWatcher:
+    """
+    读取 collection 别名，只在别名文件变化时重新读取
+    服务器每次取 collection 前调用，热路径上只有一次 stat 调用
+    """
+    def __init__(self, chroma_path):
+        self.chroma_path = chroma_path
+        self._signature = None
+        self._name = DEFAULT_COLLECTION
+
+    def current(self) -> str:
+        try:
+            st = alias_file(self.chroma_path).stat()
+            signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except FileNotFoundError:
+            signature = None
+        if signature != self._signature:
+            self._name = read_alias(self.chroma_path)
+            self._signature = signature
+        return self._name
+
+# ============ 待回收的旧版本 ============
+def retired_file(chroma_path) -> Path:
+    """待回收列表路径：<向量数据库目录的上一级>/.retired_collections.json"""
+    return Path(chroma_path).parent / ".retired_collections.json"
+
+def read_retired(chroma_path) -> dict:
+    """待回收的 collection: {名字: 切换下来的时间（Unix 秒）}"""
+    try:
+        return json.loads(retired_file(chroma_path).read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def write_retired(chroma_path, retired):
+    path = retired_file(chroma_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _write_atomic(path, json.dumps(retired, ensure_ascii=False))
+
+# ============ 重建断点 ============
+def checkpoint_file(chroma_path) -> Path:
+    """断点文件路径：<向量数据库目录的上一级>/.rebuild_checkpoint.json"""
+    return Path(chroma_path).parent / ".rebuild_checkpoint.json"
+
+def read_checkpoint(chroma_path):
+    """读取重建断点，没有（或已损坏）时返回 None"""
+    try:
+        return json.loads(checkpoint_file(chroma_path).read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+def write_checkpoint(chroma_path, state):
+    path = checkpoint_file(chroma_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _write_atomic(path, json.dumps(state, ensure_ascii=False))
+
+def clear_checkpoint(chroma_path):
+    checkpoint_file(chroma_path).unlink(missing_ok=True)
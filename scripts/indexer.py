@@ -4,63 +4,70 @@
 功能：读取 SQLite 中的备忘录，使用 BGE-M3 生成向量并存入 ChromaDB
 """
 
+import hashlib
+import re
 import sqlite3
 import chromadb
-from chromadb.api.types import EmbeddingFunction, Documents
 import os
 import sys
+import threading
+import time
 from datetime import datetime
-from typing import List
+from queue import Empty, Full, Queue
 
-# 导入 BGE-M3 模型
-from FlagEmbedding import FlagModel
+# 共享 BGE-M3 嵌入服务（每台机器只加载一份模型）
+from date_filter import timestamp_fields
+from embedding_cache import CachedEmbedder, cached_embedder, get_embedding_cache, text_key
+from embedding_pool import EMBED_WORKERS, EmbeddingPool
+from embedding_service import LazyEmbeddingFunction, get_embedding_function
+from export_notes_fixed import (
+    NoteWriter, clear_changes, delete_notes, export_changes, open_notes_db,
+    pending_changes, run_osascript
+)
+from html_cleaner import clean_html  # 也供其他脚本 from indexer import clean_html
+from index_state import (
+    DEFAULT_COLLECTION, bump_generation, clear_checkpoint, read_alias, read_checkpoint,
+    read_generation, read_retired, write_alias, write_checkpoint, write_retired
+)
+from lexical_index import drop_lexical_index, get_lexical_index
+from searcher import search
 
 # ============ 配置 ============
 NOTES_DB = os.path.expanduser("~/notes.db")
 CHROMA_DB = os.path.expanduser("~/Documents/apple-notes-mcp/chroma_db")
 LAST_SYNC_FILE = os.path.expanduser("~/Documents/apple-notes-mcp/.last_sync")
-
-# ============ BGE-M3 嵌入函数 ============
-class BGEEmbeddingFunction(EmbeddingFunction):
-    """
-    BGE-M3 嵌入函数
-    使用 BAAI/bge-m3 模型生成 1024 维向量
-    - 模型: BAAI/bge-m3
-    - 维度: 1024
-    - 特点: 优化中英文混合搜索，支持 100+ 语言
-    """
-    def __init__(self):
-        print("🚀 加载 BGE-M3 模型（首次加载会下载约2GB模型文件）...")
-        self.model = FlagModel(
-            'BAAI/bge-m3',
-            query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
-            use_fp16=True  # 使用半精度浮点数加速，M2 MAX 支持
-        )
-        print("✅ BGE-M3 模型加载完成")
-
-    def __call__(self, input: Documents) -> List[List[float]]:
-        """
-        将文本转换为向量
-        Args:
-            input: 文本列表
-        Returns:
-            向量列表（每个向量 1024 维）
-        """
-        embeddings = self.model.encode(input)
-        return embeddings.tolist()
+BATCH_SIZE = int(os.environ.get("INDEX_BATCH_SIZE", "100"))  # 每批嵌入/写入的笔记数
+PAGE_SIZE = 1000  # 删除同步时分页列出 id 的页大小
+CHUNK_CHARS = int(os.environ.get("CHUNK_CHARS", "800"))  # 每块最大字符数
+CHUNK_OVERLAP = int(os.environ.get("CHUNK_OVERLAP", "100"))  # 相邻块重叠字符数
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", "200"))  # 导出→索引之间最多缓冲的笔记数
+SCHEMA_VERSION = 2  # 元数据版本，2: 增加 created_ts / updated_ts 数值时间戳
+COLLECTION_GRACE_SECONDS = int(os.environ.get("COLLECTION_GRACE_SECONDS", "3600"))  # 切换下来的旧版本保留多久再删除
 
 # ============ 初始化 ChromaDB ============
-print("📂 初始化 ChromaDB...")
-client = chromadb.PersistentClient(path=CHROMA_DB)
+# 延迟初始化：被服务器 import 时不会重复加载模型，服务器可直接传入自己的 collection
+_client = None
+_collection = None
 
-# 使用 BGE-M3 嵌入函数
-bge_ef = BGEEmbeddingFunction()
+def get_client():
+    """获取 ChromaDB 客户端（懒加载）"""
+    global _client
+    if _client is None:
+        print("📂 初始化 ChromaDB...")
+        _client = chromadb.PersistentClient(path=CHROMA_DB)
+    return _client
 
-collection = client.get_or_create_collection(
-    name="apple_notes",
-    embedding_function=bge_ef,
-    metadata={"description": "Apple Notes 语义搜索 (BGE-M3, 1024维)"}
-)
+def get_collection():
+    """获取当前别名指向的 ChromaDB collection（懒加载，别名切换后重新打开）"""
+    global _collection
+    if _collection is None or _collection.name != read_alias(CHROMA_DB):
+        # 向量都由索引流程自己编码后传入，打开 collection 时不加载模型
+        _collection = get_client().get_or_create_collection(
+            name=read_alias(CHROMA_DB),
+            embedding_function=LazyEmbeddingFunction(),
+            metadata={"description": "Apple Notes 语义搜索 (BGE-M3, 1024维)"}
+        )
+    return _collection
 
 # ============ 读取上次同步时间 ============
 def get_last_sync_time():
@@ -77,27 +84,443 @@ def save_sync_time():
     with open(LAST_SYNC_FILE, 'w') as f:
         f.write(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
-# ============ 清理 HTML 标签（简单版）============
-def clean_html(text):
-    """移除 HTML 标签，保留纯文本"""
-    if not text:
-        return ""
-    import re
-    # 移除 HTML 标签
-    text = re.sub(r'<[^>]+>', ' ', text)
-    # 移除多余空格
-    text = re.sub(r'\s+', ' ', text)
-    return text.strip()
+# ============ 分块 ============
+# 段落之间的空行
+_PARAGRAPH_RE = re.compile(r'\n\s*\n')
+# 句末标点（中文句号/问号/叹号/分号，以及后面跟空白的英文句末标点）
+_SENTENCE_RE = re.compile(r'(?<=[。！？；])|(?<=[.!?;])\s+')
+
+def _split_sentences(paragraph, max_chars):
+    """按句末标点切句，超长句子按 max_chars 硬切"""
+    for sentence in _SENTENCE_RE.split(paragraph):
+        sentence = sentence.strip()
+        while len(sentence) > max_chars:
+            yield sentence[:max_chars]
+            sentence = sentence[max_chars:]
+        if sentence:
+            yield sentence
+
+def _join_sentences(sentences):
+    """中文句子直接相连，英文句子之间补一个空格"""
+    parts = []
+    for sentence in sentences:
+        if parts and not parts[-1].endswith(("。", "！", "？", "；")):
+            parts.append(" ")
+        parts.append(sentence)
+    return "".join(parts)
+
+def chunk_text(text, max_chars=CHUNK_CHARS, overlap=CHUNK_OVERLAP):
+    """
+    把正文切成带重叠的段落块
+    先按段落、再按中英文句子边界切分，然后把句子装箱到 max_chars 以内；
+    相邻块之间保留不超过 overlap 个字符的尾部句子作为上下文
+
+    Returns:
+        块文本列表（短笔记只有一块）
+    """
+    sentences = [
+        sentence
+        for paragraph in _PARAGRAPH_RE.split(text)
+        for sentence in _split_sentences(paragraph, max_chars)
+    ]
+
+    chunks = []
+    current = []
+    length = 0
+    for sentence in sentences:
+        if current and length + len(sentence) > max_chars:
+            chunks.append(_join_sentences(current))
+            # 从上一块尾部带入重叠句子
+            tail = []
+            tail_length = 0
+            for previous in reversed(current):
+                if tail_length + len(previous) > overlap:
+                    break
+                tail.insert(0, previous)
+                tail_length += len(previous) + 1
+            # 重叠尾部加上下一句仍不能超过 max_chars，放不下就从前面丢掉重叠句子
+            while tail and tail_length + len(sentence) > max_chars:
+                tail_length -= len(tail.pop(0)) + 1
+            current = tail
+            length = tail_length
+        current.append(sentence)
+        length += len(sentence) + 1
+
+    if current:
+        chunks.append(_join_sentences(current))
+    return chunks
+
+def chunk_id(note_id, index):
+    """块 id: <笔记 id>::<块序号>"""
+    return f"{note_id}::{index}"
+
+def parent_note_id(doc_id):
+    """块 id 还原为笔记 id（兼容旧版整篇一条的 id）"""
+    return doc_id.rpartition("::")[0] or doc_id
+
+# ============ 批量嵌入 + 写入流水线 ============
+def prepare_note(note_id, title, body, created, updated):
+    """
+    清理并分块单条笔记
+    Returns:
+        (id, 标题, 块文本列表, 元数据)，空笔记返回 None
+    """
+    # 清理 HTML 标签
+    clean_body = clean_html(body)
+
+    # 合并标题和正文（用于哈希：标题或正文任一变化都要重新嵌入）
+    if title:
+        content = f"{title}\n\n{clean_body}"
+    else:
+        content = clean_body
+
+    # 跳过空笔记
+    if not content.strip():
+        return None
+
+    passages = chunk_text(clean_body) or [title]
+
+    # 准备元数据（content_hash 用于判断正文是否真的变化，*_ts 用于日期范围过滤）
+    metadata = {
+        "note_id": note_id,
+        "title": title or "(无标题)",
+        "created": created or "",
+        "updated": updated or "",
+        **timestamp_fields(created, updated),
+        "content_hash": content_hash(content)
+    }
+    return note_id, title, passages, metadata
+
+def content_hash(content):
+    """清理后标题+正文的哈希，相同内容不重复嵌入"""
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def embed_text(title, passage):
+    """块的嵌入文本：每块都带上标题一起嵌入，保留笔记级上下文"""
+    return f"{title}\n\n{passage}" if title and passage != title else passage
+
+def _chunk_records(item):
+    """把一条笔记展开成块级记录: (块 id, 块文本, 嵌入文本, 块元数据)"""
+    note_id, title, passages, metadata = item
+    for i, passage in enumerate(passages):
+        yield chunk_id(note_id, i), passage, embed_text(title, passage), {**metadata, "chunk": i}
+
+def _existing_chunks(collection, note_ids):
+    """
+    读取这些笔记已存的块
+    Returns:
+        {笔记 id: (块 id 列表, 第一块的元数据)}
+    """
+    existing = collection.get(where={"note_id": {"$in": note_ids}}, include=["metadatas"])
+    stored = {}
+    for doc_id, metadata in zip(existing["ids"], existing["metadatas"]):
+        ids, first = stored.setdefault(metadata["note_id"], ([], metadata))
+        ids.append(doc_id)
+    return stored
+
+def _note_metadata(metadata):
+    """去掉块级字段，只比较笔记级元数据"""
+    return {k: v for k, v in metadata.items() if k != "chunk"}
+
+def _split_unchanged(stored, batch, missing_sparse=frozenset()):
+    """
+    对比已存的内容哈希
+    还没有稀疏词权重的笔记（升级前建立的索引）即使内容未变也重新嵌入
+
+    Returns:
+        (需要重新嵌入的, 只需更新元数据的, 完全未变化的条数)
+    """
+    to_embed, to_refresh, unchanged = [], [], 0
+    for item in batch:
+        old = stored.get(item[0])
+        if not old or old[1].get("content_hash") != item[3]["content_hash"]:
+            to_embed.append(item)
+        elif any(doc_id in missing_sparse for doc_id in old[0]):
+            to_embed.append(item)
+        elif _note_metadata(old[1]) != item[3]:
+            to_refresh.append(item)
+        else:
+            unchanged += 1
+    return to_embed, to_refresh, unchanged
+
+def _upsert(collection, items, stored, lexical, embedder=None):
+    """
+    一次模型前向（稠密向量 + 稀疏词权重）+ 一次 Chroma 写入事务，同时更新关键词倒排索引
+    写入新块后删除多出来的旧块（以及旧版整篇一条的文档）
+    """
+    records = [record for item in items for record in _chunk_records(item)]
+    embedder = embedder or get_embedding_function()
+    embeddings, sparse = embedder.embed_documents([record[2] for record in records])
+    collection.upsert(
+        ids=[record[0] for record in records],
+        embeddings=embeddings,
+        documents=[record[1] for record in records],
+        metadatas=[record[3] for record in records]
+    )
+
+    new_ids = {record[0] for record in records}
+    stale = [item[0] for item in items]  # 旧版 id 即笔记 id，不存在时删除是空操作
+    for item in items:
+        stale.extend(doc_id for doc_id in stored.get(item[0], ([], None))[0] if doc_id not in new_ids)
+    collection.delete(ids=stale)
+
+    lexical.upsert(
+        (record[0], record[3]["note_id"], record[2], weights)
+        for record, weights in zip(records, sparse)
+    )
+    lexical.delete(stale)
+
+def index_batch(collection, batch, lexical, log=print, verbose=False, embedder=None):
+    """
+    批量嵌入并写入一批笔记（按块写入）
+    - 内容哈希未变的笔记跳过模型，只在元数据（如修改时间）变化时更新元数据
+    - 整批失败时逐条重试，单条坏笔记不会拖垮整批
+
+    Args:
+        batch: prepare_note() 的结果列表
+        lexical: 同步更新的关键词倒排索引
+        verbose: 是否逐条打印已索引的标题
+        embedder: 提供 embed_documents() 的编码器，默认为共享嵌入函数
+    Returns:
+        (写入条数, 内容未变化跳过的条数, 索引失败的笔记 id 列表)
+    """
+    stored = _existing_chunks(collection, [item[0] for item in batch])
+    missing_sparse = lexical.missing_sparse(doc_id for ids, _ in stored.values() for doc_id in ids)
+    to_embed, to_refresh, unchanged = _split_unchanged(stored, batch, missing_sparse)
+
+    if to_refresh:
+        refresh_ids = []
+        refresh_metadatas = []
+        for note_id, _, _, metadata in to_refresh:
+            for doc_id in stored[note_id][0]:
+                refresh_ids.append(doc_id)
+                refresh_metadatas.append({**metadata, "chunk": int(doc_id.rpartition("::")[2])})
+        collection.update(ids=refresh_ids, metadatas=refresh_metadatas)
+
+    succeeded = []
+    failed = []
+    if to_embed:
+        try:
+            _upsert(collection, to_embed, stored, lexical, embedder)
+            succeeded = to_embed
+        except Exception as e:
+            log(f"  ⚠️  批量索引失败，逐条重试: {str(e)}")
+            for item in to_embed:
+                try:
+                    _upsert(collection, [item], stored, lexical, embedder)
+                    succeeded.append(item)
+                except Exception as e:
+                    failed.append(item[0])
+                    log(f"  ✗ 索引失败: {item[3]['title']} - {str(e)}")
+
+    if verbose:
+        for _, _, _, metadata in succeeded:
+            title = metadata["title"]
+            title_preview = (title[:30] + "...") if len(title) > 30 else title
+            log(f"  ✓ 索引: {title_preview}")
+    return len(succeeded) + len(to_refresh), unchanged, failed
+
+def index_notes(collection, rows, total=None, batch_size=BATCH_SIZE, lexical=None,
+                log=print, verbose=False, embedder=None, failed=None):
+    """
+    流式处理笔记行：清理 → 攒批 → 批量嵌入 → 批量写入
+
+    Args:
+        rows: (id, title, body, created, updated) 的可迭代对象
+        total: 笔记总数（用于显示进度）
+        batch_size: 每批笔记数
+        lexical: 关键词倒排索引（默认为本机向量库旁的索引文件）
+        embedder: 编码器（如 EmbeddingPool），默认为共享嵌入函数；外面再套一层持久化嵌入缓存
+        failed: 传入集合时，把索引失败的笔记 id 加进去（调用方据此保留变更日志，下次重试）
+    Returns:
+        实际写入的笔记数（内容未变化的不计入）
+    """
+    if lexical is None:
+        lexical = get_lexical_index(CHROMA_DB, collection.name)
+    embedder = cached_embedder(CHROMA_DB, embedder)
+
+    indexed_count = 0
+    unchanged_count = 0
+    processed = 0
+    batch = []
+
+    def flush():
+        nonlocal indexed_count, unchanged_count
+        written, unchanged, batch_failed = index_batch(collection, batch, lexical, log=log,
+                                                       verbose=verbose, embedder=embedder)
+        if failed is not None:
+            failed.update(batch_failed)
+        indexed_count += written
+        unchanged_count += unchanged
+        batch.clear()
+        if not verbose:
+            progress = f"{processed}/{total}" if total else f"{processed}"
+            log(f"  进度: {progress} (已索引 {indexed_count} 条，未变化 {unchanged_count} 条)")
+
+    for row in rows:
+        processed += 1
+        item = prepare_note(*row)
+        if item is not None:
+            batch.append(item)
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+    if unchanged_count:
+        log(f"  ⏭️  内容未变化，跳过嵌入: {unchanged_count} 条")
+    _log_cache_stats(embedder, log)
+    return indexed_count
+
+def _log_cache_stats(embedder, log):
+    if isinstance(embedder, CachedEmbedder) and embedder.hits + embedder.misses:
+        log(f"  💾 嵌入缓存命中 {embedder.hits} 块，模型编码 {embedder.misses} 块")
+
+# ============ 关键词索引回填 ============
+def rebuild_lexical_index(collection, lexical=None, log=print, page_size=PAGE_SIZE):
+    """
+    从 collection 中已存的段落重建关键词倒排索引（不经过模型）
+    用于升级前建立的向量库，或倒排索引文件丢失的情况
+    稀疏词权重需要模型，这里不生成；之后运行 full 时会补齐
+    """
+    if lexical is None:
+        lexical = get_lexical_index(CHROMA_DB, collection.name)
+
+    count = 0
+    offset = 0
+    while True:
+        page = collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        records = []
+        for doc_id, doc, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+            note_id = metadata.get("note_id", doc_id)
+            title = metadata.get("title", "") if "note_id" in metadata else ""  # 旧版文档已含标题
+            records.append((doc_id, note_id, f"{title}\n\n{doc}" if title else doc))
+        lexical.upsert(records)
+        count += len(records)
+        offset += len(page["ids"])
+    log(f"🔤 关键词索引已重建: {count} 块")
+    return count
+
+def ensure_lexical_index(collection, log=print):
+    """关键词索引为空而向量库有数据时自动回填"""
+    lexical = get_lexical_index(CHROMA_DB, collection.name)
+    if lexical.count() == 0 and collection.count() > 0:
+        rebuild_lexical_index(collection, lexical, log=log)
+
+# ============ 元数据迁移 ============
+def migrate_timestamps(collection, log=print, page_size=PAGE_SIZE):
+    """
+    给已有的块补上 created_ts / updated_ts（只改元数据，不重新嵌入）
+    Returns:
+        更新的块数
+    """
+    count = 0
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        ids, metadatas = [], []
+        for doc_id, metadata in zip(page["ids"], page["metadatas"]):
+            fields = timestamp_fields(metadata.get("created"), metadata.get("updated"))
+            if any(metadata.get(key) != value for key, value in fields.items()):
+                ids.append(doc_id)
+                metadatas.append({**metadata, **fields})
+        if ids:
+            collection.update(ids=ids, metadatas=metadatas)
+            count += len(ids)
+        offset += len(page["ids"])
+    log(f"🕒 已补充数值时间戳: {count} 块")
+    return count
+
+def ensure_schema(collection, log=print):
+    """
+    collection 元数据版本低于 SCHEMA_VERSION 时执行迁移
+    Returns:
+        是否做了迁移
+    """
+    metadata = dict(collection.metadata or {})
+    if metadata.get("schema_version", 1) >= SCHEMA_VERSION:
+        return False
+    migrate_timestamps(collection, log=log)
+    metadata["schema_version"] = SCHEMA_VERSION
+    collection.modify(metadata=metadata)
+    return True
+
+def upgrade_schema(collection, chroma_path=CHROMA_DB, log=print):
+    """
+    服务器打开 collection 时调用：元数据版本过旧（如数值时间戳之前建的索引）时就地迁移，不重新嵌入
+    迁移后递增索引代数，让各服务器缓存的（按旧元数据过滤出的）结果失效
+    """
+    if ensure_schema(collection, log=log):
+        bump_generation(chroma_path)
+
+# ============ 删除同步 ============
+def iter_collection_ids(collection, page_size=PAGE_SIZE):
+    """分页列出 collection 中所有 id（只取 id，不取向量和正文）"""
+    offset = 0
+    while True:
+        page = collection.get(include=[], limit=page_size, offset=offset)
+        ids = page["ids"]
+        if not ids:
+            break
+        yield from ids
+        offset += len(ids)
+
+def count_indexed_notes(collection):
+    """已索引的笔记数（按所属笔记去重，collection.count() 返回的是块数）"""
+    return len({parent_note_id(doc_id) for doc_id in iter_collection_ids(collection)})
+
+def reconcile_deletions(collection, conn, lexical=None, log=print, batch_size=PAGE_SIZE):
+    """
+    删除 notes.db 中已不存在的笔记对应的向量
+    两边 id 集合做差集，再分批删除孤儿
+
+    Returns:
+        删除的块数
+    """
+    note_ids = {row[0] for row in conn.execute("SELECT id FROM notes")}
+    if not note_ids:
+        # 导出失败时 notes.db 可能为空，此时不能把索引全删掉
+        log("⚠️  notes.db 为空，跳过删除同步")
+        return 0
+
+    # 块 id 按所属笔记判断是否为孤儿
+    orphans = [
+        doc_id for doc_id in iter_collection_ids(collection)
+        if parent_note_id(doc_id) not in note_ids
+    ]
+    if not orphans:
+        return 0
+
+    if lexical is None:
+        lexical = get_lexical_index(CHROMA_DB, collection.name)
+    for i in range(0, len(orphans), batch_size):
+        collection.delete(ids=orphans[i:i+batch_size])
+        lexical.delete(orphans[i:i+batch_size])
+    log(f"🗑️  删除已不存在笔记的向量: {len(orphans)} 块")
+    return len(orphans)
 
 # ============ 增量索引 ============
-def incremental_index():
-    """仅索引新增或修改的备忘录"""
+def incremental_index(collection=None, log=print):
+    """
+    仅索引新增或修改的备忘录
+
+    Args:
+        collection: 目标 collection（默认使用本模块懒加载的 collection）
+        log: 进度输出函数（服务器进程内调用时传入，避免写 stdout）
+    """
+    if collection is None:
+        collection = get_collection()
+
     last_sync = get_last_sync_time()
-    print(f"⏰ 上次同步时间: {last_sync}")
+    log(f"⏰ 上次同步时间: {last_sync}")
 
     if not os.path.exists(NOTES_DB):
-        print(f"❌ 错误：找不到备忘录数据库 {NOTES_DB}")
-        print("   请先运行：apple-notes-to-sqlite ~/notes.db")
+        log(f"❌ 错误：找不到备忘录数据库 {NOTES_DB}")
+        log("   请先运行：apple-notes-to-sqlite ~/notes.db")
         return
 
     # 连接 SQLite
@@ -106,132 +529,532 @@ def incremental_index():
     # 检查表结构
     cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table';")
     tables = [row[0] for row in cursor.fetchall()]
-    print(f"📋 数据库表: {', '.join(tables)}")
+    log(f"📋 数据库表: {', '.join(tables)}")
 
-    # 查询变更的笔记
-    cursor = conn.execute("""
-        SELECT id, title, body, created, updated
-        FROM notes
-        WHERE updated > ?
-        ORDER BY updated DESC
-    """, (last_sync,))
+    # 查询变更的笔记：导出脚本写了变更日志时直接用日志，
+    # 否则（其他工具生成的 notes.db）退回按修改时间比较
+    last_seq = 0
+    if "note_changes" in tables:
+        last_seq, upserts, _ = pending_changes(conn)
+        changed_notes = fetch_notes(conn, upserts)
+    else:
+        cursor = conn.execute("""
+            SELECT id, title, body, created, updated
+            FROM notes
+            WHERE updated > ?
+            ORDER BY updated DESC
+        """, (last_sync,))
+        changed_notes = cursor.fetchall()
+    log(f"🔍 发现 {len(changed_notes)} 条新增或修改的笔记")
 
-    # 获取变更的笔记
-    changed_notes = cursor.fetchall()
-    print(f"🔍 发现 {len(changed_notes)} 条新增或修改的笔记")
+    # 升级前建立的向量库先回填关键词索引和数值时间戳
+    ensure_lexical_index(collection, log=log)
+    migrated = ensure_schema(collection, log=log)
+
+    # 删除在 Apple Notes 中已被删掉的笔记
+    deleted_count = reconcile_deletions(collection, conn, log=log)
 
     if not changed_notes:
-        print("✅ 无需更新")
+        log("✅ 无需更新")
+        if last_seq:
+            clear_changes(conn, last_seq)
         conn.close()
+        if deleted_count or migrated:
+            bump_generation(CHROMA_DB)
         return
 
-    # 批量更新到 ChromaDB
-    indexed_count = 0
-    for note_id, title, body, created, updated in changed_notes:
-        # 清理 HTML 标签
-        clean_body = clean_html(body)
+    # 与全量索引共用批量流水线
+    failed = set()
+    indexed_count = index_notes(collection, changed_notes, log=log, verbose=True, failed=failed)
 
-        # 合并标题和正文
-        if title:
-            content = f"{title}\n\n{clean_body}"
-        else:
-            content = clean_body
+    if last_seq:
+        clear_changes(conn, last_seq, retry=failed)  # 索引失败的笔记留在日志里，下次重试
+    conn.close()
+    if failed:
+        log(f"⚠️  {len(failed)} 条笔记索引失败，下次同步时重试")
+    if not failed or last_seq:
+        save_sync_time()  # 没有变更日志时按修改时间比较，有失败就不推进同步时间
+    if indexed_count or deleted_count or migrated:
+        bump_generation(CHROMA_DB)  # 让服务器的结果缓存失效
+    log(f"\n✅ 索引完成！共处理 {indexed_count} 条笔记")
 
-        # 跳过空笔记
-        if not content.strip():
-            continue
+# ============ 流水线刷新（导出与索引并行） ============
+def fetch_notes(conn, ids, chunk_size=500):
+    """按 id 读取笔记行 (id, title, body, created, updated)"""
+    ids = list(ids)
+    rows = []
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i+chunk_size]
+        placeholders = ",".join("?" * len(chunk))
+        rows.extend(conn.execute(
+            f"SELECT id, title, body, created, updated FROM notes WHERE id IN ({placeholders})",
+            chunk
+        ))
+    return rows
 
-        # 准备元数据
-        metadata = {
-            "title": title or "(无标题)",
-            "created": created or "",
-            "updated": updated or ""
-        }
+_DONE = object()
 
+def _put(queue, item, stop):
+    """队列满时阻塞等待，消费者退出（stop 被设置）后放弃"""
+    while not stop.is_set():
         try:
-            # Upsert（更新或插入）
-            collection.upsert(
-                ids=[note_id],
-                documents=[content],
-                metadatas=[metadata]
-            )
+            queue.put(item, timeout=0.5)
+            return True
+        except Full:
+            continue
+    return False
+
+def _note_row(note):
+    return (note["id"], note.get("title"), note.get("body"), note.get("created"), note.get("updated"))
+
+def _export_worker(notes, queue, stop, state):
+    """
+    生产者线程: 批量写入 notes.db，内容有变化的笔记送入队列
+    之后补上变更日志里这次没有重新导出的笔记（上次索引中途失败时留下的）
+    state 回传导出条数、送入索引的条数、处理到的日志序号和异常
+    """
+    conn = open_notes_db(NOTES_DB)
+    writer = NoteWriter(conn)
+    exported_ids = set()
+    try:
+        for note in notes:
+            exported_ids.add(note["id"])
+            state["exported"] += 1
+            for changed in writer.add(note):
+                state["changed"] += 1
+                if not _put(queue, _note_row(changed), stop):
+                    return
+        for changed in writer.flush():
+            state["changed"] += 1
+            if not _put(queue, _note_row(changed), stop):
+                return
 
-            # 显示进度
-            title_preview = (title[:30] + "...") if title and len(title) > 30 else (title or "(无标题)")
-            print(f"  ✓ 索引: {title_preview}")
-            indexed_count += 1
+        last_seq, upserts, _ = pending_changes(conn)
+        for row in fetch_notes(conn, upserts - exported_ids):
+            state["changed"] += 1
+            if not _put(queue, row, stop):
+                return
+        state["last_seq"] = last_seq
+    except Exception as e:
+        state["error"] = e
+    finally:
+        # 清理出错（如 database is locked、磁盘满）也必须送出结束标记，否则消费者会一直等下去
+        try:
+            _finish_export(notes, writer, conn, state)
+        finally:
+            _put(queue, _DONE, stop)
 
+def _finish_export(notes, writer, conn, state):
+    """
+    结束 osascript 进程（提前退出时），已导出的笔记都是完整的行，出错时也落盘保留
+    每一步的异常记入 state，不打断后面的步骤
+    """
+    steps = [getattr(notes, "close", None), writer.flush, conn.commit, conn.close]
+    for step in steps:
+        if step is None:
+            continue
+        try:
+            step()
         except Exception as e:
-            print(f"  ✗ 索引失败: {title or '(无标题)'} - {str(e)}")
+            if state["error"] is None:
+                state["error"] = e
+
+def _drain(queue, producer):
+    """逐条取出队列中的笔记，直到结束标记；生产者意外退出、没送出结束标记时取完剩余的也结束"""
+    while True:
+        try:
+            item = queue.get(timeout=1.0)
+        except Empty:
+            if producer.is_alive():
+                continue
+            try:
+                item = queue.get_nowait()
+            except Empty:
+                return
+        if item is _DONE:
+            return
+        yield item
+
+def streaming_refresh(collection=None, log=print, runner=run_osascript):
+    """
+    边导出边索引: 两阶段增量导出（先列出 id/修改时间，再只取变更笔记的正文），
+    osascript 逐条产出的笔记经有界队列送入 清理 → 哈希 → 批量嵌入 流水线，
+    嵌入与缓慢的 AppleScript 导出重叠进行；导出完整结束后再做删除同步
+
+    Args:
+        collection: 目标 collection（默认使用本模块懒加载的 collection）
+        log: 进度输出函数
+        runner: 执行 AppleScript 的函数（测试时可传入回放录制输出的假 runner）
+    Returns:
+        实际写入的笔记数
+    """
+    if collection is None:
+        collection = get_collection()
+
+    last_sync = get_last_sync_time()
+    log(f"⏰ 上次同步时间: {last_sync}")
+
+    # 第一阶段：列出 id/修改时间，与 notes.db 对比
+    conn = open_notes_db(NOTES_DB)
+    try:
+        notes, deleted = export_changes(conn, runner)
+        delete_notes(conn, deleted)
+        conn.commit()
+    finally:
+        conn.close()
+    if deleted:
+        log(f"🗑️  Apple Notes 中已删除: {len(deleted)} 条")
+
+    # 升级前建立的向量库先回填关键词索引和数值时间戳
+    ensure_lexical_index(collection, log=log)
+    migrated = ensure_schema(collection, log=log)
+
+    queue = Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+    state = {"exported": 0, "changed": 0, "last_seq": 0, "error": None}
+    failed = set()
+    producer = threading.Thread(
+        target=_export_worker,
+        args=(notes, queue, stop, state),
+        daemon=True
+    )
+    producer.start()
+    try:
+        indexed_count = index_notes(collection, _drain(queue, producer), log=log, verbose=True,
+                                    failed=failed)
+    finally:
+        stop.set()  # 索引出错时让生产者尽快退出
+        producer.join()
+
+    log(f"📤 已导出正文 {state['exported']} 条笔记")
+    log(f"🔍 发现 {state['changed']} 条新增或修改的笔记")
+
+    if state["error"] is not None:
+        # 导出不完整：保留已写入的向量，但不做删除同步、不推进同步时间
+        if indexed_count:
+            bump_generation(CHROMA_DB)
+        raise RuntimeError(f"导出失败: {state['error']}")
 
+    # 删除在 Apple Notes 中已被删掉的笔记
+    conn = sqlite3.connect(NOTES_DB)
+    deleted_count = reconcile_deletions(collection, conn, log=log)
+    if state["last_seq"] or failed:
+        clear_changes(conn, state["last_seq"], retry=failed)  # 索引失败的笔记留在日志里，下次重试
     conn.close()
+    if failed:
+        log(f"⚠️  {len(failed)} 条笔记索引失败，下次同步时重试")
+
     save_sync_time()
-    print(f"\n✅ 索引完成！共处理 {indexed_count} 条笔记")
+    if indexed_count or deleted_count or migrated:
+        bump_generation(CHROMA_DB)  # 让服务器的结果缓存失效
+    if state["changed"] == 0:
+        log("✅ 无需更新")
+    log(f"\n✅ 索引完成！共处理 {indexed_count} 条笔记")
+    return indexed_count
 
-# ============ 全量索引（首次使用） ============
-def full_index():
-    """索引所有备忘录（首次运行）"""
-    print("🔄 执行全量索引...")
+# ============ 可续跑的全量重建 ============
+def _find_collection(client, name):
+    """按名字打开已存在的 collection，不存在时返回 None"""
+    try:
+        return client.get_collection(name=name, embedding_function=LazyEmbeddingFunction())
+    except Exception:
+        return None
 
-    if not os.path.exists(NOTES_DB):
-        print(f"❌ 错误：找不到备忘录数据库 {NOTES_DB}")
-        print("   请先运行：apple-notes-to-sqlite ~/notes.db")
-        return
+_VERSION_RE = re.compile(rf"^{DEFAULT_COLLECTION}_v(\d+)$")
 
-    conn = sqlite3.connect(NOTES_DB)
-    cursor = conn.execute("SELECT id, title, body, created, updated FROM notes")
+def next_collection_name(live_name):
+    """下一个版本的 collection 名：apple_notes_v{n+1}（旧的未带版本号的名字算作 v0）"""
+    match = _VERSION_RE.match(live_name)
+    version = int(match.group(1)) if match else 0
+    return f"{DEFAULT_COLLECTION}_v{version + 1}"
 
-    all_notes = cursor.fetchall()
-    print(f"📊 总共 {len(all_notes)} 条笔记")
+def _drop_collection(client, chroma_path, name):
+    """删除 collection 及其倒排索引"""
+    try:
+        client.delete_collection(name=name)
+    except Exception:
+        pass  # 已经不存在
+    drop_lexical_index(chroma_path, name)
 
-    if len(all_notes) == 0:
-        print("⚠️  没有找到笔记，请检查 Apple Notes 中是否有内容")
-        conn.close()
-        return
+def collect_retired(client, chroma_path=CHROMA_DB, grace=COLLECTION_GRACE_SECONDS, log=print):
+    """
+    回收切换下来超过宽限期的旧版本 collection
+    宽限期内旧版本保留，切换瞬间还在旧版本上执行的查询不会失败
+    Returns:
+        删除的 collection 数
+    """
+    retired = read_retired(chroma_path)
+    live_name = read_alias(chroma_path)
+    now = time.time()
+    kept = {}
+    for name, retired_at in retired.items():
+        if name == live_name:
+            continue
+        if now - retired_at < grace:
+            kept[name] = retired_at
+            continue
+        _drop_collection(client, chroma_path, name)
+        log(f"🧹 已回收旧版本 collection: {name}")
+    if kept != retired:
+        write_retired(chroma_path, kept)
+    return len(retired) - len(kept)
 
-    batch_size = 100
-    indexed_count = 0
+def compact_embedding_cache(collection, chroma_path=CHROMA_DB, log=print, page_size=PAGE_SIZE):
+    """
+    回收嵌入缓存：只保留当前 collection 里还在用的块
+    嵌入文本按块文本和标题还原；无标题笔记的元数据标题是占位符，两种写法的哈希都保留
+    collection 不存在或为空时拒绝回收（多半是向量数据库路径不对，回收会清空整个缓存）
+    Returns:
+        删除的缓存条目数
+    """
+    cache = get_embedding_cache(chroma_path)
+    if cache is None:
+        return 0
+    if collection is None or collection.count() == 0:
+        log(f"⚠️  {chroma_path} 下没有可用的索引，跳过嵌入缓存回收")
+        return 0
+    keep = set()
+    offset = 0
+    while True:
+        page = collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        for passage, metadata in zip(page["documents"], page["metadatas"]):
+            keep.add(text_key(passage))
+            keep.add(text_key(embed_text(metadata.get("title"), passage)))
+        offset += len(page["ids"])
+    removed = cache.compact(keep)
+    if removed:
+        log(f"🧹 嵌入缓存回收 {removed} 条，保留 {cache.count()} 条")
+    return removed
 
-    for i in range(0, len(all_notes), batch_size):
-        batch = all_notes[i:i+batch_size]
+def _copy_unchanged(live, live_lexical, shadow, shadow_lexical, batch):
+    """
+    内容哈希未变、分块也相同（逐块比对段落文本，分块参数变了就重新嵌入）的笔记，
+    直接从当前 collection 复制向量、段落和稀疏词权重，不经过模型
+    Returns:
+        (仍需嵌入的笔记, 复制的条数)
+    """
+    stored = live.get(
+        where={"note_id": {"$in": [item[0] for item in batch]}},
+        include=["embeddings", "documents", "metadatas"]
+    )
+    chunks = {}
+    for doc_id, document, metadata, embedding in zip(
+        stored["ids"], stored["documents"], stored["metadatas"], stored["embeddings"]
+    ):
+        chunks.setdefault(metadata["note_id"], {})[doc_id] = (metadata, embedding, document)
+    sparse = live_lexical.sparse_weights(stored["ids"])
 
-        ids = []
-        documents = []
-        metadatas = []
+    to_embed, copied = [], []
+    for item in batch:
+        old = chunks.get(item[0], {})
+        records = list(_chunk_records(item))
+        reusable = len(old) == len(records) and all(
+            record[0] in old and record[0] in sparse
+            and old[record[0]][0].get("content_hash") == item[3]["content_hash"]
+            and old[record[0]][2] == record[1]
+            for record in records
+        )
+        if reusable:
+            copied.extend((record, old[record[0]][1], sparse[record[0]]) for record in records)
+        else:
+            to_embed.append(item)
 
-        for note_id, title, body, created, updated in batch:
-            # 清理 HTML 标签
-            clean_body = clean_html(body)
+    if copied:
+        shadow.upsert(
+            ids=[record[0] for record, _, _ in copied],
+            embeddings=[embedding for _, embedding, _ in copied],
+            documents=[record[1] for record, _, _ in copied],
+            metadatas=[record[3] for record, _, _ in copied]
+        )
+        shadow_lexical.upsert(
+            (record[0], record[3]["note_id"], record[2], weights) for record, _, weights in copied
+        )
+    return to_embed, len(batch) - len(to_embed)
 
-            # 合并标题和正文
-            if title:
-                content = f"{title}\n\n{clean_body}"
-            else:
-                content = clean_body
+def rebuild_index(client, conn, chroma_path=CHROMA_DB, batch_size=BATCH_SIZE, log=print, embedder=None,
+                  failed=None):
+    """
+    全量重建到新版本的影子 collection（apple_notes_v{n}），完成后原子切换别名
+    - 读者在重建期间一直使用原来的 collection，不会看到半空的索引
+    - 每批写入后记录断点（已处理到的笔记 id + 索引代数），中断后重新运行从断点继续
+    - 断点之后索引代数变了（期间有增量写入），或重建过程中有写入，从头再比对一遍；
+      已写入影子的笔记内容未变时不会重新嵌入
+    - 内容未变的笔记从原 collection 复制；其余的块先查持久化嵌入缓存，都没有才经过模型
+    - 切换下来的旧版本过了宽限期（COLLECTION_GRACE_SECONDS）后在下一次重建时回收
+    - 有笔记索引失败时不切换：别名、索引代数和旧版本都不动，断点保留，
+      重新运行时从头比对影子（已写入的不会重新嵌入），只重试失败的笔记
 
-            # 跳过空笔记
-            if not content.strip():
-                continue
+    Args:
+        client: ChromaDB 客户端
+        conn: notes.db 连接
+        failed: 传入集合时，把索引失败的笔记 id 加进去
+    Returns:
+        (切换后的 collection, 重新嵌入的笔记数)；有失败时返回原来的 collection（可能为 None）
+    """
+    collect_retired(client, chroma_path, log=log)
+    embedder = cached_embedder(chroma_path, embedder)
+    live_name = read_alias(chroma_path)
+    live = _find_collection(client, live_name)
+    live_lexical = get_lexical_index(chroma_path, live_name) if live is not None else None
+    generation = read_generation(chroma_path)
+
+    checkpoint = read_checkpoint(chroma_path)
+    shadow = None
+    last_id = ""
+    if checkpoint and checkpoint.get("source") == live_name:
+        shadow = _find_collection(client, checkpoint["collection"])
+    elif checkpoint and checkpoint.get("collection") != live_name:
+        # 别名已经变过的过期断点，它的影子从未提供过服务，直接删除
+        _drop_collection(client, chroma_path, checkpoint["collection"])
+    if shadow is not None:
+        if checkpoint.get("generation") != generation:
+            log(f"⏯️  继续重建 {shadow.name}：断点之后索引有更新，从头比对")
+        elif checkpoint["last_id"]:
+            last_id = checkpoint["last_id"]
+            log(f"⏯️  从断点继续重建 {shadow.name}（已处理到 {last_id}）")
+        else:
+            log(f"⏯️  继续重建 {shadow.name}：上次有笔记索引失败，从头比对")
+    else:
+        shadow_name = next_collection_name(live_name)
+        _drop_collection(client, chroma_path, shadow_name)  # 没有断点的残留（如断点文件丢失）
+        shadow = client.create_collection(
+            name=shadow_name,
+            embedding_function=LazyEmbeddingFunction(),
+            metadata={
+                "description": "Apple Notes 语义搜索 (BGE-M3, 1024维)",
+                "schema_version": SCHEMA_VERSION
+            }
+        )
+        log(f"🏗️  重建到影子 collection: {shadow_name}")
+    lexical = get_lexical_index(chroma_path, shadow.name)
 
-            ids.append(note_id)
-            documents.append(content)
-            metadatas.append({
-                "title": title or "(无标题)",
-                "created": created or "",
-                "updated": updated or ""
+    total = conn.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+    embedded = copied = 0
+    while True:
+        failures = set()  # 每一遍都覆盖全部笔记，只看最后一遍的失败
+        processed = conn.execute("SELECT COUNT(*) FROM notes WHERE id <= ?", (last_id,)).fetchone()[0]
+        while True:
+            # 按主键分批读取，断点就是上一批的最后一个 id
+            rows = conn.execute(
+                "SELECT id, title, body, created, updated FROM notes WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            batch = [item for item in (prepare_note(*row) for row in rows) if item is not None]
+            if batch and live is not None:
+                batch, reused = _copy_unchanged(live, live_lexical, shadow, lexical, batch)
+                copied += reused
+            if batch:
+                written, _, batch_failed = index_batch(shadow, batch, lexical, log=log, embedder=embedder)
+                embedded += written
+                failures.update(batch_failed)
+            processed += len(rows)
+            last_id = rows[-1][0]
+            write_checkpoint(chroma_path, {
+                "source": live_name,
+                "collection": shadow.name,
+                "last_id": last_id,
+                "generation": generation
             })
-            indexed_count += 1
+            log(f"  进度: {processed}/{total} (重新嵌入 {embedded} 条，复用 {copied} 条)")
 
-        if ids:  # 只有在有数据时才索引
-            try:
-                collection.upsert(ids=ids, documents=documents, metadatas=metadatas)
-                print(f"  进度: {min(i+batch_size, len(all_notes))}/{len(all_notes)} (已索引 {indexed_count} 条)")
-            except Exception as e:
-                print(f"  ✗ 批量索引失败: {str(e)}")
+        # 重建期间原 collection 有增量写入时，已处理过的笔记可能已经过时
+        current = read_generation(chroma_path)
+        if current == generation:
+            break
+        log("🔁 重建期间索引有更新，再比对一遍")
+        generation = current
+        last_id = ""
+
+    if failures:
+        if failed is not None:
+            failed.update(failures)
+        # 影子缺了这些笔记，切过去读者会看到不完整的索引
+        write_checkpoint(chroma_path, {
+            "source": live_name,
+            "collection": shadow.name,
+            "last_id": "",
+            "generation": generation
+        })
+        _log_cache_stats(embedder, log)
+        log(f"⚠️  {len(failures)} 条笔记索引失败，未切换到 {shadow.name}，继续使用 {live_name}")
+        log("   重新运行会从断点继续，只重试失败的笔记")
+        return live, embedded
+
+    reconcile_deletions(shadow, conn, lexical=lexical, log=log)
+    write_alias(chroma_path, shadow.name)
+    clear_checkpoint(chroma_path)
+    bump_generation(chroma_path)  # 让服务器的结果缓存失效
+    _log_cache_stats(embedder, log)
+    log(f"🔀 已切换到 {shadow.name}")
+    if live is not None:
+        write_retired(chroma_path, {**read_retired(chroma_path), live_name: time.time()})
+        log(f"   旧版本 {live_name} 保留 {COLLECTION_GRACE_SECONDS} 秒后回收")
+    # 只在完整、无失败的切换之后回收，缓存不会随着历次编辑无限增长
+    compact_embedding_cache(shadow, chroma_path, log=log)
+    return shadow, embedded
+
+# ============ 全量索引（首次使用） ============
+def full_index(collection=None, log=print, workers=EMBED_WORKERS):
+    """
+    索引所有备忘录（首次运行 / 完全重建）
+    重建到影子 collection 后原子切换，可中断续跑（见 rebuild_index）
+    workers > 1 时用多进程嵌入池并行编码，向量仍由当前进程统一写入
+    """
+    global _collection
+
+    log("🔄 执行全量索引...")
+
+    if not os.path.exists(NOTES_DB):
+        log(f"❌ 错误：找不到备忘录数据库 {NOTES_DB}")
+        log("   请先运行：apple-notes-to-sqlite ~/notes.db")
+        return
+
+    conn = sqlite3.connect(NOTES_DB)
+    total = conn.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+    log(f"📊 总共 {total} 条笔记")
+
+    if total == 0:
+        log("⚠️  没有找到笔记，请检查 Apple Notes 中是否有内容")
+        conn.close()
+        return
+
+    # 当前 collection 补齐关键词索引和元数据，重建时才能直接复用
+    if collection is None:
+        collection = get_collection()
+    ensure_lexical_index(collection, log=log)
+    ensure_schema(collection, log=log)
+
+    # 全量索引覆盖变更日志里的所有条目，完成后一并清除
+    has_journal = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='note_changes'"
+    ).fetchone() is not None
+    last_seq = pending_changes(conn)[0] if has_journal else 0
+
+    failed = set()
+    if workers > 1:
+        # 每批凑够所有进程的工作量，写入仍是每批一次
+        with EmbeddingPool(workers, log=log) as pool:
+            _collection, indexed_count = rebuild_index(
+                get_client(), conn, batch_size=BATCH_SIZE * workers, log=log, embedder=pool,
+                failed=failed
+            )
+    else:
+        _collection, indexed_count = rebuild_index(get_client(), conn, log=log, failed=failed)
+    if failed:
+        # 没有切换：变更日志和同步时间都不动，原 collection 仍由增量索引维护
+        conn.close()
+        log(f"\n❌ 全量索引未完成：{len(failed)} 条笔记索引失败，重新运行 full 从断点继续")
+        return
+    if has_journal:
+        clear_changes(conn, last_seq)
 
     conn.close()
     save_sync_time()
-    print(f"\n✅ 全量索引完成！共索引 {indexed_count} 条笔记")
+    log(f"\n✅ 全量索引完成！共重新嵌入 {indexed_count} 条笔记")
 
 # ============ 测试搜索 ============
 def test_search(query, limit=5):
@@ -239,21 +1062,19 @@ def test_search(query, limit=5):
     print(f"\n🔍 搜索: {query}")
 
     try:
-        results = collection.query(
-            query_texts=[query],
-            n_results=limit
-        )
+        collection = get_collection()
+        notes = search(collection, query, limit, lexical=get_lexical_index(CHROMA_DB, collection.name))
 
-        if not results['documents'][0]:
+        if not notes:
             print("❌ 没有找到相关结果")
             return
 
-        print(f"✅ 找到 {len(results['documents'][0])} 个结果:\n")
-        for i, (doc, metadata) in enumerate(zip(results['documents'][0], results['metadatas'][0])):
+        print(f"✅ 找到 {len(notes)} 个结果:\n")
+        for i, note in enumerate(notes):
             print(f"--- 结果 {i+1} ---")
-            print(f"标题: {metadata['title']}")
-            print(f"内容预览: {doc[:200]}...")
-            print(f"更新时间: {metadata['updated']}\n")
+            print(f"标题: {note['title']}")
+            print(f"最佳段落: {note['passage'][:200]}...")
+            print(f"更新时间: {note['updated']}\n")
     except Exception as e:
         print(f"❌ 搜索失败: {str(e)}")
 
@@ -265,7 +1086,8 @@ def show_stats():
 
     try:
         # ChromaDB 统计
-        indexed_count = collection.count()
+        collection = get_collection()
+        indexed_count = count_indexed_notes(collection)
         print(f"已索引笔记数: {indexed_count}")
 
         # SQLite 统计
@@ -303,18 +1125,52 @@ if __name__ == "__main__":
         command = sys.argv[1]
 
         if command == "full":
-            full_index()
+            if len(sys.argv) > 2:
+                full_index(workers=int(sys.argv[2]))
+            else:
+                full_index()
         elif command == "search":
             query = " ".join(sys.argv[2:]) if len(sys.argv) > 2 else "项目"
             test_search(query)
         elif command == "stats":
             show_stats()
+        elif command == "lexical":
+            rebuild_lexical_index(get_collection())
+            bump_generation(CHROMA_DB)
+        elif command == "refresh":
+            streaming_refresh()
+        elif command == "migrate":
+            if ensure_schema(get_collection()):
+                bump_generation(CHROMA_DB)
+        elif command == "gc":
+            collect_retired(get_client(), grace=int(sys.argv[2]) if len(sys.argv) > 2 else COLLECTION_GRACE_SECONDS)
+        elif command == "cache-gc":
+            # 只打开别名指向的现有 collection，不会新建空的
+            chroma_path = os.path.expanduser(sys.argv[2]) if len(sys.argv) > 2 else CHROMA_DB
+            if os.path.isdir(chroma_path):
+                client = get_client() if chroma_path == CHROMA_DB else chromadb.PersistentClient(path=chroma_path)
+                live = _find_collection(client, read_alias(chroma_path))
+            else:
+                live = None
+            compact_embedding_cache(live, chroma_path)
+        elif command == "prune":
+            conn = sqlite3.connect(NOTES_DB)
+            if reconcile_deletions(get_collection(), conn):
+                bump_generation(CHROMA_DB)
+            conn.close()
         else:
             print("用法:")
             print("  python3 indexer.py           # 增量索引（默认）")
             print("  python3 indexer.py full      # 全量索引（首次运行）")
+            print("  python3 indexer.py full <N>  # 全量索引，N 个进程并行嵌入（CPU 机器）")
+            print("  python3 indexer.py refresh   # 导出 Apple Notes 并同时增量索引")
             print("  python3 indexer.py search <关键词>  # 测试搜索")
             print("  python3 indexer.py stats     # 显示统计信息")
+            print("  python3 indexer.py prune     # 删除已不存在笔记的向量")
+            print("  python3 indexer.py gc [秒]   # 回收切换下来超过宽限期的旧版本 collection")
+            print("  python3 indexer.py cache-gc [向量数据库目录]  # 回收嵌入缓存中当前索引已不再使用的条目")
+            print("  python3 indexer.py lexical   # 重建关键词索引（不重新嵌入）")
+            print("  python3 indexer.py migrate   # 升级元数据（补充数值时间戳，不重新嵌入）")
     else:
         # 默认执行增量索引
         incremental_index()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+本地倒排索引（BM25）
+与 Chroma 向量库并排存放的 SQLite 文件，补充纯向量检索对生僻中文词、型号、人名等精确匹配的不足。
+- 中文: 字符二元组（bigram），单字词保留单字
+- 英文/数字: 小写单词，型号中的 . _ - 连接符保留（如 rtx-4090、v2.1）
+查询只读 SQLite，不经过模型，毫秒级返回；随索引脚本增量更新。
+
+同一文件还存放 BGE-M3 的稀疏词权重（sparse_postings），
+查询时用查询的词权重与文档词权重做点积，作为第三路排名参与融合。
+"""
+
+import math
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+from pathlib import Path
+
+# ============ 配置 ============
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# ============ 分词 ============
+_TOKEN_RE = re.compile(
+    r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+'  # 连续的中日韩统一表意文字
+    r'|[0-9a-z]+(?:[._-][0-9a-z]+)*'                 # 英文单词、数字和型号
+)
+_CJK_START = '\u3400'
+
+def tokenize(text):
+    """中文切成二元组，英文按单词切分，全部 NFKC 规范化并小写"""
+    tokens = []
+    for match in _TOKEN_RE.finditer(unicodedata.normalize("NFKC", text).lower()):
+        run = match.group()
+        if run[0] >= _CJK_START:
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i+2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+# ============ 倒排索引 ============
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    doc_id TEXT PRIMARY KEY,
+    note_id TEXT,
+    length INTEGER
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT,
+    doc_id TEXT,
+    tf INTEGER,
+    PRIMARY KEY (term, doc_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_doc ON postings(doc_id);
+CREATE TABLE IF NOT EXISTS sparse_postings (
+    token_id INTEGER,
+    doc_id TEXT,
+    weight REAL,
+    PRIMARY KEY (token_id, doc_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS sparse_postings_doc ON sparse_postings(doc_id);
+"""
+
+class LexicalIndex:
+    """块级 BM25 倒排索引（doc_id 与 Chroma 中的块 id 一致）"""
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()  # 每个线程一个连接
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(docs)")}
+            if "has_sparse" not in columns:
+                # 旧版索引文件没有稀疏权重，标记为 0，索引脚本会补齐
+                conn.execute("ALTER TABLE docs ADD COLUMN has_sparse INTEGER DEFAULT 0")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")  # 索引写入时查询照常进行
+            self._local.conn = conn
+        return conn
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def upsert(self, records):
+        """
+        写入或覆盖块
+        Args:
+            records: (doc_id, note_id, text) 或 (doc_id, note_id, text, sparse) 列表，
+                     sparse 为 BGE-M3 的稀疏词权重 {token_id: weight}
+        """
+        records = list(records)
+        with self._connect() as conn:
+            self._delete(conn, [record[0] for record in records])
+            for doc_id, note_id, text, *rest in records:
+                sparse = rest[0] if rest else None
+                terms = Counter(tokenize(text))
+                conn.execute(
+                    "INSERT INTO docs (doc_id, note_id, length, has_sparse) VALUES (?, ?, ?, ?)",
+                    (doc_id, note_id, sum(terms.values()), int(sparse is not None))
+                )
+                conn.executemany(
+                    "INSERT INTO postings (term, doc_id, tf) VALUES (?, ?, ?)",
+                    [(term, doc_id, tf) for term, tf in terms.items()]
+                )
+                if sparse:
+                    conn.executemany(
+                        "INSERT INTO sparse_postings (token_id, doc_id, weight) VALUES (?, ?, ?)",
+                        [(int(token), doc_id, float(weight)) for token, weight in sparse.items()]
+                    )
+
+    def delete(self, doc_ids):
+        with self._connect() as conn:
+            self._delete(conn, list(doc_ids))
+
+    @staticmethod
+    def _delete(conn, doc_ids):
+        rows = [(doc_id,) for doc_id in doc_ids]
+        conn.executemany("DELETE FROM postings WHERE doc_id = ?", rows)
+        conn.executemany("DELETE FROM sparse_postings WHERE doc_id = ?", rows)
+        conn.executemany("DELETE FROM docs WHERE doc_id = ?", rows)
+
+    def missing_sparse(self, doc_ids):
+        """返回给定块中还没有稀疏权重的 doc_id 集合（不在索引里的也算）"""
+        doc_ids = list(doc_ids)
+        if not doc_ids:
+            return set()
+        placeholders = ",".join("?" * len(doc_ids))
+        rows = self._connect().execute(
+            f"SELECT doc_id FROM docs WHERE has_sparse = 1 AND doc_id IN ({placeholders})",
+            doc_ids
+        ).fetchall()
+        return set(doc_ids) - {row[0] for row in rows}
+
+    def sparse_weights(self, doc_ids):
+        """
+        读取块的稀疏词权重（重建索引时复用，不经过模型）
+        Returns:
+            {doc_id: {token_id: weight}}，只包含已有稀疏权重的块
+        """
+        doc_ids = list(doc_ids)
+        if not doc_ids:
+            return {}
+        conn = self._connect()
+        placeholders = ",".join("?" * len(doc_ids))
+        weights = {
+            row[0]: {} for row in conn.execute(
+                f"SELECT doc_id FROM docs WHERE has_sparse = 1 AND doc_id IN ({placeholders})",
+                doc_ids
+            )
+        }
+        rows = conn.execute(
+            f"SELECT doc_id, token_id, weight FROM sparse_postings WHERE doc_id IN ({placeholders})",
+            doc_ids
+        )
+        for doc_id, token_id, weight in rows:
+            if doc_id in weights:
+                weights[doc_id][token_id] = weight
+        return weights
+
+    def search(self, query, limit=20):
+        """
+        BM25 检索
+        Returns:
+            [(doc_id, note_id, score)]，按得分降序
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        conn = self._connect()
+        total, avg_length = conn.execute("SELECT COUNT(*), AVG(length) FROM docs").fetchone()
+        if not total:
+            return []
+
+        placeholders = ",".join("?" * len(terms))
+        rows = conn.execute(f"""
+            SELECT p.term, p.doc_id, p.tf, d.length, d.note_id
+            FROM postings p JOIN docs d ON d.doc_id = p.doc_id
+            WHERE p.term IN ({placeholders})
+        """, list(terms)).fetchall()
+
+        df = Counter(row[0] for row in rows)
+        scores = {}
+        note_ids = {}
+        for term, doc_id, tf, length, note_id in rows:
+            idf = math.log(1 + (total - df[term] + 0.5) / (df[term] + 0.5))
+            norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / (avg_length or 1))
+            scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+            note_ids[doc_id] = note_id
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(doc_id, note_ids[doc_id], score) for doc_id, score in ranked]
+
+    def search_sparse(self, query_weights, limit=20):
+        """
+        稀疏词权重检索: score = Σ 查询权重 × 文档权重（与 BGE-M3 的 lexical matching 一致）
+        Args:
+            query_weights: 查询的稀疏词权重 {token_id: weight}
+        Returns:
+            [(doc_id, note_id, score)]，按得分降序
+        """
+        if not query_weights:
+            return []
+        tokens = [int(token) for token in query_weights]
+        placeholders = ",".join("?" * len(tokens))
+        rows = self._connect().execute(f"""
+            SELECT s.token_id, s.doc_id, s.weight, d.note_id
+            FROM sparse_postings s JOIN docs d ON d.doc_id = s.doc_id
+            WHERE s.token_id IN ({placeholders})
+        """, tokens).fetchall()
+
+        weights = {int(token): float(weight) for token, weight in query_weights.items()}
+        scores = {}
+        note_ids = {}
+        for token_id, doc_id, weight, note_id in rows:
+            scores[doc_id] = scores.get(doc_id, 0.0) + weights[token_id] * weight
+            note_ids[doc_id] = note_id
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(doc_id, note_ids[doc_id], score) for doc_id, score in ranked if score > 0]
+
+# ============ 按 collection 获取 ============
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def lexical_index_path(chroma_path, collection_name):
+    """倒排索引文件: <向量数据库目录的上一级>/lexical_index/<collection 名>.db"""
+    return Path(chroma_path).parent / "lexical_index" / f"{collection_name}.db"
+
+def get_lexical_index(chroma_path, collection_name):
+    """获取（并缓存）某个 collection 对应的倒排索引"""
+    path = lexical_index_path(chroma_path, collection_name)
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = LexicalIndex(path)
+        return _indexes[path]
+
+def drop_lexical_index(chroma_path, collection_name):
+    """删除某个 collection 的倒排索引文件（回收旧版本 collection 时使用）"""
+    path = lexical_index_path(chroma_path, collection_name)
+    with _indexes_lock:
+        _indexes.pop(path, None)
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{path}{suffix}").unlink(missing_ok=True)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+搜索结果缓存
+缓存检索结果（笔记列表），键为 (工具名, 规范化查询, limit, 日期过滤...)；输出由调用方按每次请求的原始查询格式化。
+每条结果记录生成时的索引代数，索引写入后代数加一，旧结果自动失效。
+
+环境变量配置:
+    RESULT_CACHE_SIZE: 缓存的结果条数（默认 256，0 关闭）
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from index_state import GenerationWatcher
+
+# ============ 配置 ============
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "256"))
+
+# ============ 结果缓存 ============
+class ResultCache:
+    """按索引代数失效的 LRU 结果缓存"""
+    def __init__(self, chroma_path, maxsize: int = RESULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._watcher = GenerationWatcher(chroma_path)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key, compute):
+        """
+        命中且代数未变时直接返回缓存，否则调用 compute() 并缓存
+        compute 抛出的异常不会被缓存
+        """
+        with self._lock:
+            # 先取代数再计算：计算期间发生的索引写入会让这条结果下次失效
+            generation = self._watcher.current()
+            entry = self._data.get(key)
+            if entry is not None and entry[0] == generation:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = compute()
+
+        if self.maxsize > 0:
+            with self._lock:
+                self._data[key] = (generation, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "generation": self._watcher.current()
+            }
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+共享检索逻辑
+索引按块存储（一篇长笔记对应多个块），这里把块级命中合并回笔记级结果，
+每篇笔记只保留得分最高的段落。server / server_http / server_cloud / api_server 共用。
+
+混合检索: 向量检索（Chroma）+ BM25 关键词检索 + BGE-M3 稀疏词权重检索（lexical_index），
+三路排名用倒数排名融合（RRF）合并，精确匹配的生僻词和型号不会被语义相近的笔记挤掉。
+查询的稠密向量和稀疏词权重来自同一次模型前向。
+
+日期过滤: 按内存日期索引估算选择性，窗口很窄时对窗口内的块做精确向量计算，
+否则走 HNSW 近似检索 + where 过滤。
+"""
+
+import os
+
+import numpy as np
+
+from date_filter import range_where
+from embedding_service import get_embedding_function
+
+# ============ 配置 ============
+FETCH_FACTOR = 4  # 块级召回数 = limit × FETCH_FACTOR，合并后仍能凑满 limit 篇笔记
+RRF_K = 60        # RRF 平滑常数，越大越平均地对待各路排名
+EXACT_MAX_CHUNKS = int(os.environ.get("EXACT_MAX_CHUNKS", "2000"))          # 精确计算的块数上限
+EXACT_SELECTIVITY = float(os.environ.get("EXACT_SELECTIVITY", "0.1"))        # 命中比例低于此值才精确计算
+
+# ============ 检索 ============
+def search(collection, query, limit=5, where=None, lexical=None,
+           updated_range=None, date_index=None):
+    """
+    检索并按笔记合并
+
+    Args:
+        collection: ChromaDB collection
+        query: 查询文本
+        limit: 返回的笔记数
+        where: Chroma 元数据过滤条件
+        lexical: LexicalIndex，传入时启用混合检索
+        updated_range: 更新时间范围 (start, end)，Unix 秒闭区间，None 表示不限
+        date_index: DateIndex，传入时按选择性决定是否对时间窗口内的块精确计算
+    Returns:
+        笔记列表，每项包含 note_id / title / updated / passage / distance，按相关度排序
+    """
+    total = collection.count()
+    if total == 0:
+        return []
+
+    range_filter = range_where(*updated_range) if updated_range else None
+    if range_filter is not None:
+        where = {"$and": [where, range_filter]} if where else range_filter
+
+    n_results = min(limit * FETCH_FACTOR, total)
+    query_embedding, query_sparse = get_embedding_function().embed_query_with_sparse(query)
+
+    candidates = None
+    if range_filter is not None and date_index is not None:
+        ids, total_chunks = date_index.select(*updated_range)
+        if len(ids) <= EXACT_MAX_CHUNKS and len(ids) <= total_chunks * EXACT_SELECTIVITY:
+            candidates = ids
+
+    if candidates is not None:
+        if not candidates:
+            return []
+        dense = exact_search(collection, query_embedding, candidates, n_results, where)
+    else:
+        results = collection.query(
+            query_embeddings=[query_embedding],
+            n_results=n_results,
+            where=where,
+            include=["documents", "metadatas", "distances"]
+        )
+        dense = best_chunk_per_note(
+            results['ids'][0],
+            results['documents'][0],
+            results['metadatas'][0],
+            results['distances'][0]
+        )
+    if lexical is None:
+        return dense[:limit]
+
+    keyword_rankings = [
+        lexical.search(query, n_results),
+        lexical.search_sparse(query_sparse, n_results)
+    ]
+    return fuse(collection, query_embedding, dense, keyword_rankings, limit, where)
+
+def exact_search(collection, query_embedding, candidates, n_results, where=None):
+    """
+    只在给定的块里做精确（暴力）向量检索，用于选择性很高的过滤条件
+    距离与 Chroma 默认的 l2 空间一致（平方欧氏距离），结果可与 HNSW 路径互换
+    """
+    fetched = collection.get(
+        ids=list(candidates),
+        where=where,
+        include=["documents", "metadatas", "embeddings"]
+    )
+    if not len(fetched['ids']):
+        return []
+    matrix = np.asarray(fetched['embeddings'], dtype=np.float32)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    distances = ((matrix - query) ** 2).sum(axis=1)
+    order = np.argsort(distances, kind="stable")[:n_results]
+    return best_chunk_per_note(
+        [fetched['ids'][i] for i in order],
+        [fetched['documents'][i] for i in order],
+        [fetched['metadatas'][i] for i in order],
+        [float(distances[i]) for i in order]
+    )
+
+def best_chunk_per_note(ids, documents, metadatas, distances):
+    """块级命中（已按距离升序）合并为笔记级结果，每篇笔记取最佳段落"""
+    notes = []
+    seen = set()
+    for doc_id, doc, metadata, distance in zip(ids, documents, metadatas, distances):
+        # 旧版索引没有 note_id 字段，文档 id 就是笔记 id
+        note_id = metadata.get('note_id', doc_id)
+        if note_id in seen:
+            continue
+        seen.add(note_id)
+        notes.append({
+            "note_id": note_id,
+            "title": metadata.get('title', '(无标题)'),
+            "updated": metadata.get('updated', ''),
+            "passage": doc,
+            "distance": distance
+        })
+    return notes
+
+# ============ 融合 ============
+def _squared_l2(a, b):
+    """与 Chroma 默认的 l2 空间一致的距离"""
+    return sum((x - y) ** 2 for x, y in zip(a, b))
+
+def fuse(collection, query_embedding, dense, keyword_rankings, limit, where=None):
+    """
+    倒数排名融合: score = Σ 1 / (RRF_K + rank)
+    只出现在关键词结果里的笔记，从 Chroma 取回段落（同时套用 where 过滤）并补算向量距离
+
+    Args:
+        keyword_rankings: 若干路关键词结果，每路为 [(doc_id, note_id, score)]
+    """
+    dense_by_note = {note["note_id"]: note for note in dense}
+
+    # 每路关键词结果按笔记去重，保留最佳块
+    keyword_best = []
+    for hits in keyword_rankings:
+        best = {}
+        for doc_id, note_id, _ in hits:
+            best.setdefault(note_id, doc_id)
+        keyword_best.append(best)
+
+    missing = {}
+    for best in keyword_best:
+        for note_id, doc_id in best.items():
+            if note_id not in dense_by_note:
+                missing.setdefault(note_id, doc_id)
+    missing = list(missing.values())
+    keyword_only = {}
+    if missing:
+        fetched = collection.get(
+            ids=missing,
+            where=where,
+            include=["documents", "metadatas", "embeddings"]
+        )
+        for doc_id, doc, metadata, embedding in zip(
+            fetched['ids'], fetched['documents'], fetched['metadatas'], fetched['embeddings']
+        ):
+            note_id = metadata.get('note_id', doc_id)
+            keyword_only[note_id] = {
+                "note_id": note_id,
+                "title": metadata.get('title', '(无标题)'),
+                "updated": metadata.get('updated', ''),
+                "passage": doc,
+                "distance": _squared_l2(query_embedding, embedding)
+            }
+
+    scores = {}
+    for rank, note in enumerate(dense):
+        scores[note["note_id"]] = 1 / (RRF_K + rank + 1)
+    for best in keyword_best:
+        rank = 0
+        for note_id in best:
+            if note_id in dense_by_note or note_id in keyword_only:
+                rank += 1  # 被 where 过滤掉的笔记不占名次
+                scores[note_id] = scores.get(note_id, 0.0) + 1 / (RRF_K + rank)
+
+    ranked = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [dense_by_note.get(note_id) or keyword_only[note_id] for note_id in ranked]
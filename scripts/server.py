@@ -5,52 +5,28 @@ Apple Notes MCP 服务器
 """
 
 import sys
+import threading
 import os
 import sqlite3
-import subprocess
 from pathlib import Path
-from typing import List
 
 import chromadb
-from chromadb.api.types import EmbeddingFunction, Documents
 from fastmcp import FastMCP
 
-# 导入 BGE-M3 模型
-from FlagEmbedding import FlagModel
+# 共享 BGE-M3 嵌入服务（每台机器只加载一份模型）
+from embedding_service import get_embedding_function, normalize_query
+from date_filter import date_range
+from date_index import get_date_index
+from index_state import AliasWatcher
+from lexical_index import get_lexical_index
+from search_cache import ResultCache
+from searcher import search
+from worker_pool import run_blocking, run_maintenance
+from indexer import count_indexed_notes, streaming_refresh, upgrade_schema
 
 # ============ 配置 ============
 NOTES_DB = Path.home() / "notes.db"
 CHROMA_DB = Path.home() / "Documents/apple-notes-mcp/chroma_db"
-INDEXER_SCRIPT = Path.home() / "Documents/apple-notes-mcp/scripts/indexer.py"
-
-# ============ BGE-M3 嵌入函数 ============
-class BGEEmbeddingFunction(EmbeddingFunction):
-    """
-    BGE-M3 嵌入函数
-    使用 BAAI/bge-m3 模型生成 1024 维向量
-    - 模型: BAAI/bge-m3
-    - 维度: 1024
-    - 特点: 优化中英文混合搜索，支持 100+ 语言
-    """
-    def __init__(self):
-        print("🚀 加载 BGE-M3 模型...", file=sys.stderr)
-        self.model = FlagModel(
-            'BAAI/bge-m3',
-            query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
-            use_fp16=True  # 使用半精度浮点数加速，M2 MAX 支持
-        )
-        print("✅ BGE-M3 模型加载完成", file=sys.stderr)
-
-    def __call__(self, input: Documents) -> List[List[float]]:
-        """
-        将文本转换为向量
-        Args:
-            input: 文本列表
-        Returns:
-            向量列表（每个向量 1024 维）
-        """
-        embeddings = self.model.encode(input)
-        return embeddings.tolist()
 
 # ============ 初始化 MCP 和 ChromaDB ============
 mcp = FastMCP(name="apple-notes-search")
@@ -59,60 +35,64 @@ mcp = FastMCP(name="apple-notes-search")
 _chroma_client = None
 _collection = None
 _bge_ef = None
+_init_lock = threading.Lock()  # 工作线程可能并发触发懒加载
+_alias_watcher = AliasWatcher(CHROMA_DB)  # 当前提供服务的 collection 名
 
 def get_collection():
-    """获取 ChromaDB collection（懒加载）"""
+    """获取别名指向的 ChromaDB collection（懒加载，重建切换别名后自动换到新版本，无需重启）"""
     global _chroma_client, _collection, _bge_ef
-    if _collection is None:
-        _chroma_client = chromadb.PersistentClient(path=str(CHROMA_DB))
-
-        # 初始化 BGE-M3 嵌入函数
-        if _bge_ef is None:
-            _bge_ef = BGEEmbeddingFunction()
-
-        _collection = _chroma_client.get_or_create_collection(
-            "apple_notes",
-            embedding_function=_bge_ef
-        )
+    name = _alias_watcher.current()
+    with _init_lock:
+        if _collection is None or _collection.name != name:
+            if _chroma_client is None:
+                _chroma_client = chromadb.PersistentClient(path=str(CHROMA_DB))
+
+            # 初始化 BGE-M3 嵌入函数
+            if _bge_ef is None:
+                _bge_ef = get_embedding_function()
+
+            collection = _chroma_client.get_or_create_collection(
+                name,
+                embedding_function=_bge_ef
+            )
+            # 旧版本建的索引没有数值时间戳，日期过滤会查不到，打开时先迁移
+            upgrade_schema(collection, CHROMA_DB, log=lambda message: print(message, file=sys.stderr))
+            _collection = collection
     return _collection
 
-# ============ 工具 1: 搜索备忘录 ============
-@mcp.tool()
-async def search_notes(query: str, limit: int = 5) -> str:
-    """
-    在 Apple Notes 中进行语义搜索
-
-    Args:
-        query: 搜索关键词或问题（支持模糊匹配和语义理解）
-        limit: 返回结果数量（默认5条，最多20条）
+# 搜索结果缓存（索引更新后自动失效）
+_result_cache = ResultCache(CHROMA_DB)
 
-    Returns:
-        匹配的备忘录列表，包含标题、内容和更新时间
-    """
+# ============ 工具 1: 搜索备忘录 ============
+def _search_notes_sync(query: str, limit: int = 5) -> str:
+    """语义搜索（同步实现，在工作线程中执行）"""
     try:
         # 限制最大返回数量
         limit = min(limit, 20)
 
-        collection = get_collection()
-        results = collection.query(
-            query_texts=[query],
-            n_results=limit
-        )
+        def compute():
+            collection = get_collection()
+            return search(collection, query, limit, lexical=get_lexical_index(CHROMA_DB, collection.name))
+
+        # 相同查询在索引未变化时直接复用检索结果；输出按本次请求的原始查询格式化，
+        # 规范化后相同的不同写法不会拿到别人的查询文本
+        key = ("search_notes", normalize_query(query), limit)
+        notes = _result_cache.get_or_compute(key, compute)
 
-        if not results['documents'][0]:
+        if not notes:
             return "❌ 没有找到相关备忘录"
 
         # 格式化输出（Markdown格式）
         output = [f"# 搜索结果：{query}\n"]
-        output.append(f"找到 {len(results['documents'][0])} 个相关结果\n")
+        output.append(f"找到 {len(notes)} 个相关结果\n")
 
-        for i, (doc, metadata) in enumerate(zip(results['documents'][0], results['metadatas'][0])):
-            title = metadata.get('title', '(无标题)')
-            updated = metadata.get('updated', '')
+        for i, note in enumerate(notes):
+            title = note['title']
+            updated = note['updated']
 
             output.append(f"## {i+1}. {title}")
             output.append(f"**更新时间**: {updated[:10] if updated else '未知'}")
-            output.append(f"\n{doc[:400]}...")
+            output.append(f"\n{note['passage']}")  # 最匹配的段落
             output.append("\n---\n")
 
         return "\n".join(output)
@@ -120,62 +100,64 @@ async def search_notes(query: str, limit: int = 5) -> str:
     except Exception as e:
         return f"❌ 搜索失败: {str(e)}\n\n请确保已经运行过索引脚本。"
 
-# ============ 工具 2: 精细化搜索 ============
 @mcp.tool()
-async def refine_search(
-    query: str,
-    date_after: str = "",
-    date_before: str = "",
-    limit: int = 5
-) -> str:
+async def search_notes(query: str, limit: int = 5) -> str:
     """
-    使用过滤条件进行更精确的搜索
+    在 Apple Notes 中进行语义搜索
 
     Args:
-        query: 搜索查询
-        date_after: 只搜索此日期之后的笔记（格式：YYYY-MM-DD）
-        date_before: 只搜索此日期之前的笔记（格式：YYYY-MM-DD）
-        limit: 返回结果数量
+        query: 搜索关键词或问题（支持模糊匹配和语义理解）
+        limit: 返回结果数量（默认5条，最多20条）
 
     Returns:
-        筛选后的备忘录列表
+        匹配的备忘录列表，包含标题、内容和更新时间
     """
+    return await run_blocking(_search_notes_sync, query, limit)
+
+# ============ 工具 2: 精细化搜索 ============
+def _refine_search_sync(
+    query: str,
+    date_after: str = "",
+    date_before: str = "",
+    limit: int = 5
+) -> str:
+    """带过滤条件的搜索（同步实现，在工作线程中执行）"""
     try:
         limit = min(limit, 20)
 
-        # 构建过滤条件
-        where = {}
-        if date_after:
-            where["updated"] = {"$gte": date_after}
-        if date_before:
-            if "updated" in where:
-                where["updated"]["$lte"] = date_before
-            else:
-                where["updated"] = {"$lte": date_before}
+        # 构建过滤条件（数值时间戳范围，date_before 包含当天）
+        updated_range = date_range(date_after, date_before)
 
-        collection = get_collection()
-        results = collection.query(
-            query_texts=[query],
-            n_results=limit,
-            where=where if where else None
-        )
+        def compute():
+            collection = get_collection()
+            return search(
+                collection, query, limit,
+                lexical=get_lexical_index(CHROMA_DB, collection.name),
+                updated_range=updated_range,
+                date_index=get_date_index(CHROMA_DB, collection)
+            )
+
+        # 相同查询在索引未变化时直接复用检索结果；输出按本次请求的原始查询格式化，
+        # 规范化后相同的不同写法不会拿到别人的查询文本
+        key = ("refine_search", normalize_query(query), limit, date_after, date_before)
+        notes = _result_cache.get_or_compute(key, compute)
 
-        if not results['documents'][0]:
+        if not notes:
             return "❌ 没有找到符合条件的备忘录"
 
         # 格式化输出
         output = [f"# 精细搜索结果：{query}\n"]
         if date_after or date_before:
             output.append(f"**时间范围**: {date_after or '不限'} ~ {date_before or '不限'}\n")
-        output.append(f"找到 {len(results['documents'][0])} 个结果\n")
+        output.append(f"找到 {len(notes)} 个结果\n")
 
-        for i, (doc, metadata) in enumerate(zip(results['documents'][0], results['metadatas'][0])):
-            title = metadata.get('title', '(无标题)')
-            updated = metadata.get('updated', '')
+        for i, note in enumerate(notes):
+            title = note['title']
+            updated = note['updated']
 
             output.append(f"## {i+1}. {title}")
             output.append(f"**更新时间**: {updated[:10] if updated else '未知'}")
-            output.append(f"\n{doc[:400]}...")
+            output.append(f"\n{note['passage']}")  # 最匹配的段落
             output.append("\n---\n")
 
         return "\n".join(output)
@@ -183,74 +165,70 @@ async def refine_search(
     except Exception as e:
         return f"❌ 搜索失败: {str(e)}"
 
-# ============ 工具 3: 刷新索引 ============
 @mcp.tool()
-async def refresh_index() -> str:
+async def refine_search(
+    query: str,
+    date_after: str = "",
+    date_before: str = "",
+    limit: int = 5
+) -> str:
     """
-    手动触发备忘录导出和重新索引
+    使用过滤条件进行更精确的搜索
 
-    这个操作会：
-    1. 重新导出 Apple Notes 到 SQLite
-    2. 增量更新向量数据库（只索引新增/修改的笔记）
+    Args:
+        query: 搜索查询
+        date_after: 只搜索此日期之后的笔记（格式：YYYY-MM-DD）
+        date_before: 只搜索此日期之前的笔记（格式：YYYY-MM-DD）
+        limit: 返回结果数量
 
     Returns:
-        操作结果和统计信息
+        筛选后的备忘录列表
     """
+    return await run_blocking(_refine_search_sync, query, date_after, date_before, limit)
+
+# ============ 工具 3: 刷新索引 ============
+def _refresh_index_sync() -> str:
+    """导出并增量索引（同步实现，在维护线程中执行）"""
     try:
         output = ["# 刷新索引\n"]
 
-        # 1. 导出备忘录（使用UTF-8修复版）
-        output.append("## 步骤 1: 导出备忘录")
-        result = subprocess.run(
-            [
-                "python3",
-                str(Path.home() / "Documents/apple-notes-mcp/scripts/export_notes_fixed.py")
-            ],
-            capture_output=True,
-            text=True,
-            timeout=120
-        )
-
-        if result.returncode != 0:
-            return f"❌ 导出失败:\n{result.stderr}"
-
-        output.append("✅ 导出成功\n")
-
-        # 2. 运行索引脚本
-        output.append("## 步骤 2: 更新索引")
-        result = subprocess.run(
-            ["python3", str(INDEXER_SCRIPT)],
-            capture_output=True,
-            text=True,
-            timeout=120
-        )
-
-        if result.returncode != 0:
-            return f"❌ 索引失败:\n{result.stderr}"
+        # 导出与索引并行：osascript 每产出一条笔记就送入嵌入流水线，
+        # 在进程内完成（复用已加载的模型和 collection）
+        output.append("## 导出备忘录并更新索引")
+        progress = []
+        try:
+            streaming_refresh(collection=get_collection(), log=progress.append)
+        except Exception as e:
+            return f"❌ 刷新失败:\n{str(e)}"
 
         # 提取关键信息
-        stdout_lines = result.stdout.split('\n')
-        for line in stdout_lines:
-            if '发现' in line or '索引完成' in line or '无需更新' in line:
+        for line in progress:
+            if '导出' in line or '发现' in line or '索引完成' in line or '无需更新' in line:
                 output.append(f"- {line.strip()}")
 
         output.append("\n✅ **刷新完成！**")
         return "\n".join(output)
 
-    except subprocess.TimeoutExpired:
-        return "❌ 操作超时，请稍后重试"
     except Exception as e:
         return f"❌ 刷新失败: {str(e)}"
 
-# ============ 工具 4: 获取统计信息 ============
 @mcp.tool()
-async def get_stats() -> str:
+async def refresh_index() -> str:
     """
-    查看备忘录数量和索引状态
+    手动触发备忘录导出和重新索引
+
+    这个操作会：
+    1. 重新导出 Apple Notes 到 SQLite
+    2. 增量更新向量数据库（只索引新增/修改的笔记）
 
     Returns:
-        统计信息，包括总笔记数、已索引数、覆盖率等
+        操作结果和统计信息
     """
+    return await run_maintenance(_refresh_index_sync)
+
+# ============ 工具 4: 获取统计信息 ============
+def _get_stats_sync() -> str:
+    """统计信息（同步实现，在工作线程中执行）"""
     try:
         # 从 SQLite 获取总数
         if not NOTES_DB.exists():
@@ -263,11 +241,15 @@ async def get_stats() -> str:
 
         # 从 ChromaDB 获取索引数
         collection = get_collection()
-        indexed_count = collection.count()
+        indexed_count = count_indexed_notes(collection)
 
         # 计算覆盖率
         coverage = (indexed_count / total_notes * 100) if total_notes > 0 else 0
 
+        # 查询向量缓存
+        cache = get_embedding_function().query_cache.stats()
+        results_cache = _result_cache.stats()
+
         return f"""# 备忘录统计
 
 📊 **总体情况**
@@ -275,6 +257,11 @@ async def get_stats() -> str:
 - 已索引数: {indexed_count}
 - 索引覆盖率: {coverage:.1f}%
 
+⚡ **查询缓存**
+- 缓存条数: {cache['size']}/{cache['maxsize']}
+- 命中率: {cache['hit_rate'] * 100:.1f}% ({cache['hits']} 命中 / {cache['misses']} 未命中)
+- 结果缓存: {results_cache['size']}/{results_cache['maxsize']}，命中率 {results_cache['hit_rate'] * 100:.1f}%（索引代数 {results_cache['generation']}）
+
 📂 **文件位置**
 - SQLite 数据库: `{NOTES_DB}`
 - 向量数据库: `{CHROMA_DB}`
@@ -286,6 +273,16 @@ async def get_stats() -> str:
     except Exception as e:
         return f"❌ 获取统计失败: {str(e)}"
 
+@mcp.tool()
+async def get_stats() -> str:
+    """
+    查看备忘录数量和索引状态
+
+    Returns:
+        统计信息，包括总笔记数、已索引数、覆盖率等
+    """
+    return await run_blocking(_get_stats_sync)
+
 # ============ 启动服务器 ============
 if __name__ == "__main__":
     print("=" * 60)
@@ -293,7 +290,6 @@ if __name__ == "__main__":
     print("=" * 60)
     print(f"📂 备忘录数据库: {NOTES_DB}")
     print(f"🗂️  向量数据库: {CHROMA_DB}")
-    print(f"🔧 索引脚本: {INDEXER_SCRIPT}")
     print()
     print("✅ 可用工具:")
     print("  - search_notes: 语义搜索备忘录")
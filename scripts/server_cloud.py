@@ -10,18 +10,26 @@ Apple Notes MCP 服务器 (云端部署版本)
 """
 
 import sys
+import threading
 import os
 import sqlite3
 import subprocess
 from pathlib import Path
-from typing import List, Optional
+from typing import Optional
 
 import chromadb
-from chromadb.api.types import EmbeddingFunction, Documents
 from fastmcp import FastMCP
 
-# 导入 BGE-M3 模型
-from FlagEmbedding import FlagModel
+# 共享 BGE-M3 嵌入服务（每台机器只加载一份模型）
+from embedding_service import get_embedding_function, normalize_query
+from date_filter import date_range
+from date_index import get_date_index
+from index_state import AliasWatcher
+from indexer import count_indexed_notes, upgrade_schema
+from lexical_index import get_lexical_index
+from search_cache import ResultCache
+from searcher import search
+from worker_pool import run_blocking
 
 # ============ 配置 ============
 # 从环境变量读取配置
@@ -43,25 +51,6 @@ if not API_KEY:
 
 print(f"✅ API Key 已配置: {API_KEY[:8]}...", file=sys.stderr)
 
-# ============ BGE-M3 嵌入函数 ============
-class BGEEmbeddingFunction(EmbeddingFunction):
-    """
-    BGE-M3 嵌入函数
-    使用 BAAI/bge-m3 模型生成 1024 维向量
-    """
-    def __init__(self):
-        print("🚀 加载 BGE-M3 模型...", file=sys.stderr)
-        self.model = FlagModel(
-            'BAAI/bge-m3',
-            query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
-            use_fp16=True
-        )
-        print("✅ BGE-M3 模型加载完成", file=sys.stderr)
-
-    def __call__(self, input: Documents) -> List[List[float]]:
-        embeddings = self.model.encode(input)
-        return embeddings.tolist()
-
 # ============ 初始化 MCP ============
 mcp = FastMCP(name="apple-notes-search")
 
@@ -69,30 +58,41 @@ mcp = FastMCP(name="apple-notes-search")
 _chroma_client = None
 _collection = None
 _bge_ef = None
+_init_lock = threading.Lock()  # 工作线程可能并发触发懒加载
+_alias_watcher = AliasWatcher(CHROMA_DB)  # 当前提供服务的 collection 名
 
 def get_collection():
-    """获取 ChromaDB collection（懒加载）"""
+    """获取别名指向的 ChromaDB collection（懒加载，重建切换别名后自动换到新版本，无需重启）"""
     global _chroma_client, _collection, _bge_ef
-    if _collection is None:
-        if not CHROMA_DB.exists():
-            raise FileNotFoundError(
-                f"向量数据库不存在: {CHROMA_DB}\n"
-                "请先运行索引脚本: python3 scripts/build_index_cloud.py"
+    name = _alias_watcher.current()
+    with _init_lock:
+        if _collection is None or _collection.name != name:
+            if not CHROMA_DB.exists():
+                raise FileNotFoundError(
+                    f"向量数据库不存在: {CHROMA_DB}\n"
+                    "请先运行索引脚本: python3 scripts/build_index_cloud.py"
+                )
+
+            if _chroma_client is None:
+                _chroma_client = chromadb.PersistentClient(path=str(CHROMA_DB))
+
+            if _bge_ef is None:
+                _bge_ef = get_embedding_function()
+
+            collection = _chroma_client.get_or_create_collection(
+                name,
+                embedding_function=_bge_ef
             )
-
-        _chroma_client = chromadb.PersistentClient(path=str(CHROMA_DB))
-
-        if _bge_ef is None:
-            _bge_ef = BGEEmbeddingFunction()
-
-        _collection = _chroma_client.get_or_create_collection(
-            "apple_notes",
-            embedding_function=_bge_ef
-        )
-        print(f"✅ 向量数据库已加载，笔记数: {_collection.count()}", file=sys.stderr)
+            # 旧版本建的索引没有数值时间戳，日期过滤会查不到，打开时先迁移
+            upgrade_schema(collection, CHROMA_DB, log=lambda message: print(message, file=sys.stderr))
+            _collection = collection
+            print(f"✅ 向量数据库已加载: {name}，向量块数: {_collection.count()}", file=sys.stderr)
 
     return _collection
 
+# 搜索结果缓存（索引更新后自动失效）
+_result_cache = ResultCache(CHROMA_DB)
+
 # ============ API Key 验证中间件 ============
 # 注意: FastMCP 2.x 可能没有内置的中间件支持
 # 我们需要在工具层面进行验证
@@ -105,45 +105,34 @@ def verify_api_key(provided_key: Optional[str]) -> bool:
 
 # ============ 工具定义 ============
 
-@mcp.tool()
-async def search_notes(query: str, api_key: str, limit: int = 5) -> str:
-    """
-    在 Apple Notes 中进行语义搜索
-
-    Args:
-        query: 搜索关键词或问题（支持模糊匹配和语义理解）
-        api_key: API 密钥（必需）
-        limit: 返回结果数量（默认5条，最多20条）
-
-    Returns:
-        匹配的备忘录列表，包含标题、内容和更新时间
-    """
-    # 验证 API Key
-    if not verify_api_key(api_key):
-        return "❌ 认证失败: API Key 无效"
-
+def _search_notes_sync(query: str, limit: int = 5) -> str:
+    """语义搜索（同步实现，在工作线程中执行）"""
     try:
         limit = min(limit, 20)
-        collection = get_collection()
-        results = collection.query(
-            query_texts=[query],
-            n_results=limit
-        )
 
-        if not results['documents'][0]:
+        def compute():
+            collection = get_collection()
+            return search(collection, query, limit, lexical=get_lexical_index(CHROMA_DB, collection.name))
+
+        # 相同查询在索引未变化时直接复用检索结果；输出按本次请求的原始查询格式化，
+        # 规范化后相同的不同写法不会拿到别人的查询文本
+        key = ("search_notes", normalize_query(query), limit)
+        notes = _result_cache.get_or_compute(key, compute)
+
+        if not notes:
             return "❌ 没有找到相关备忘录"
 
         # 格式化输出
         output = [f"# 搜索结果：{query}\n"]
-        output.append(f"找到 {len(results['documents'][0])} 个相关结果\n")
+        output.append(f"找到 {len(notes)} 个相关结果\n")
 
-        for i, (doc, metadata) in enumerate(zip(results['documents'][0], results['metadatas'][0])):
-            title = metadata.get('title', '(无标题)')
-            updated = metadata.get('updated', '')
+        for i, note in enumerate(notes):
+            title = note['title']
+            updated = note['updated']
 
             output.append(f"## {i+1}. {title}")
             output.append(f"**更新时间**: {updated[:10] if updated else '未知'}")
-            output.append(f"\n{doc[:400]}...")
+            output.append(f"\n{note['passage']}")  # 最匹配的段落
             output.append("\n---\n")
 
         return "\n".join(output)
@@ -152,63 +141,66 @@ async def search_notes(query: str, api_key: str, limit: int = 5) -> str:
         return f"❌ 搜索失败: {str(e)}"
 
 @mcp.tool()
-async def refine_search(
-    query: str,
-    api_key: str,
-    date_after: str = "",
-    date_before: str = "",
-    limit: int = 5
-) -> str:
+async def search_notes(query: str, api_key: str, limit: int = 5) -> str:
     """
-    使用过滤条件进行更精确的搜索
+    在 Apple Notes 中进行语义搜索
 
     Args:
-        query: 搜索查询
+        query: 搜索关键词或问题（支持模糊匹配和语义理解）
         api_key: API 密钥（必需）
-        date_after: 只搜索此日期之后的笔记（格式：YYYY-MM-DD）
-        date_before: 只搜索此日期之前的笔记（格式：YYYY-MM-DD）
-        limit: 返回结果数量
+        limit: 返回结果数量（默认5条，最多20条）
 
     Returns:
-        筛选后的备忘录列表
+        匹配的备忘录列表，包含标题、内容和更新时间
     """
+    # 验证 API Key
     if not verify_api_key(api_key):
         return "❌ 认证失败: API Key 无效"
 
+    return await run_blocking(_search_notes_sync, query, limit)
+
+def _refine_search_sync(
+    query: str,
+    date_after: str = "",
+    date_before: str = "",
+    limit: int = 5
+) -> str:
+    """带过滤条件的搜索（同步实现，在工作线程中执行）"""
     try:
         limit = min(limit, 20)
 
-        where = {}
-        if date_after:
-            where["updated"] = {"$gte": date_after}
-        if date_before:
-            if "updated" in where:
-                where["updated"]["$lte"] = date_before
-            else:
-                where["updated"] = {"$lte": date_before}
+        # 数值时间戳范围，date_before 包含当天
+        updated_range = date_range(date_after, date_before)
 
-        collection = get_collection()
-        results = collection.query(
-            query_texts=[query],
-            n_results=limit,
-            where=where if where else None
-        )
+        def compute():
+            collection = get_collection()
+            return search(
+                collection, query, limit,
+                lexical=get_lexical_index(CHROMA_DB, collection.name),
+                updated_range=updated_range,
+                date_index=get_date_index(CHROMA_DB, collection)
+            )
 
-        if not results['documents'][0]:
+        # 相同查询在索引未变化时直接复用检索结果；输出按本次请求的原始查询格式化，
+        # 规范化后相同的不同写法不会拿到别人的查询文本
+        key = ("refine_search", normalize_query(query), limit, date_after, date_before)
+        notes = _result_cache.get_or_compute(key, compute)
+
+        if not notes:
             return "❌ 没有找到符合条件的备忘录"
 
         output = [f"# 精细搜索结果：{query}\n"]
         if date_after or date_before:
             output.append(f"**时间范围**: {date_after or '不限'} ~ {date_before or '不限'}\n")
-        output.append(f"找到 {len(results['documents'][0])} 个结果\n")
+        output.append(f"找到 {len(notes)} 个结果\n")
 
-        for i, (doc, metadata) in enumerate(zip(results['documents'][0], results['metadatas'][0])):
-            title = metadata.get('title', '(无标题)')
-            updated = metadata.get('updated', '')
+        for i, note in enumerate(notes):
+            title = note['title']
+            updated = note['updated']
 
             output.append(f"## {i+1}. {title}")
             output.append(f"**更新时间**: {updated[:10] if updated else '未知'}")
-            output.append(f"\n{doc[:400]}...")
+            output.append(f"\n{note['passage']}")  # 最匹配的段落
             output.append("\n---\n")
 
         return "\n".join(output)
@@ -217,19 +209,33 @@ async def refine_search(
         return f"❌ 搜索失败: {str(e)}"
 
 @mcp.tool()
-async def get_stats(api_key: str) -> str:
+async def refine_search(
+    query: str,
+    api_key: str,
+    date_after: str = "",
+    date_before: str = "",
+    limit: int = 5
+) -> str:
     """
-    查看备忘录数量和索引状态
+    使用过滤条件进行更精确的搜索
 
     Args:
+        query: 搜索查询
         api_key: API 密钥（必需）
+        date_after: 只搜索此日期之后的笔记（格式：YYYY-MM-DD）
+        date_before: 只搜索此日期之前的笔记（格式：YYYY-MM-DD）
+        limit: 返回结果数量
 
     Returns:
-        统计信息，包括总笔记数、已索引数、覆盖率等
+        筛选后的备忘录列表
     """
     if not verify_api_key(api_key):
         return "❌ 认证失败: API Key 无效"
 
+    return await run_blocking(_refine_search_sync, query, date_after, date_before, limit)
+
+def _get_stats_sync() -> str:
+    """统计信息（同步实现，在工作线程中执行）"""
     try:
         if not NOTES_DB.exists():
             return "❌ 备忘录数据库不存在"
@@ -240,10 +246,14 @@ async def get_stats(api_key: str) -> str:
         conn.close()
 
         collection = get_collection()
-        indexed_count = collection.count()
+        indexed_count = count_indexed_notes(collection)
 
         coverage = (indexed_count / total_notes * 100) if total_notes > 0 else 0
 
+        # 查询向量缓存
+        cache = get_embedding_function().query_cache.stats()
+        results_cache = _result_cache.stats()
+
         return f"""# 备忘录统计
 
 📊 **总体情况**
@@ -251,6 +261,11 @@ async def get_stats(api_key: str) -> str:
 - 已索引数: {indexed_count}
 - 索引覆盖率: {coverage:.1f}%
 
+⚡ **查询缓存**
+- 缓存条数: {cache['size']}/{cache['maxsize']}
+- 命中率: {cache['hit_rate'] * 100:.1f}% ({cache['hits']} 命中 / {cache['misses']} 未命中)
+- 结果缓存: {results_cache['size']}/{results_cache['maxsize']}，命中率 {results_cache['hit_rate'] * 100:.1f}%（索引代数 {results_cache['generation']}）
+
 💡 **提示**
 这是你的私有 Apple Notes 语义搜索实例。
 """
@@ -258,6 +273,22 @@ async def get_stats(api_key: str) -> str:
     except Exception as e:
         return f"❌ 获取统计失败: {str(e)}"
 
+@mcp.tool()
+async def get_stats(api_key: str) -> str:
+    """
+    查看备忘录数量和索引状态
+
+    Args:
+        api_key: API 密钥（必需）
+
+    Returns:
+        统计信息，包括总笔记数、已索引数、覆盖率等
+    """
+    if not verify_api_key(api_key):
+        return "❌ 认证失败: API Key 无效"
+
+    return await run_blocking(_get_stats_sync)
+
 # ============ 健康检查端点 ============
 @mcp.tool()
 async def health_check() -> str:
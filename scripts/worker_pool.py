@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+阻塞任务执行层
+MCP 工具都是 async def，但 Chroma 查询（含 BGE-M3 编码）、sqlite3 和 subprocess 都是同步阻塞调用。
+这里把它们放到有界线程池里执行，避免一个慢请求卡住整个事件循环（SSE 模式下会拖慢所有客户端）。
+
+两条独立的通道:
+    - 查询通道: search_notes / refine_search / get_stats，并发数由 MCP_WORKERS 控制
+    - 维护通道: refresh_index 等长任务，单线程串行，不占用查询通道的名额
+
+环境变量配置:
+    MCP_WORKERS: 查询通道的并发数（默认 4）
+"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# ============ 配置 ============
+MAX_WORKERS = int(os.environ.get("MCP_WORKERS", "4"))
+
+_query_executor = None
+_maintenance_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executors():
+    """懒加载线程池（只在第一次调用工具时创建）"""
+    global _query_executor, _maintenance_executor
+    with _executor_lock:
+        if _query_executor is None:
+            _query_executor = ThreadPoolExecutor(
+                max_workers=max(1, MAX_WORKERS),
+                thread_name_prefix="notes-query"
+            )
+            _maintenance_executor = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix="notes-maintenance"
+            )
+    return _query_executor, _maintenance_executor
+
+# ============ 执行入口 ============
+async def run_blocking(func, *args, **kwargs):
+    """在查询通道中执行阻塞函数，不阻塞事件循环"""
+    executor, _ = _get_executors()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+async def run_maintenance(func, *args, **kwargs):
+    """在维护通道中执行长任务（串行执行，刷新期间搜索照常响应）"""
+    _, executor = _get_executors()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))